@@ -0,0 +1,328 @@
+"""
+Compute the all-pairs inter-run agreement matrix for every base image.
+"""
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+
+from mask_archive import MaskArchive, overlap_packed
+from metric_cache import MetricCache
+from overlap import overlap_masks
+from repository import get_repository
+import roi
+from sidecar import SidecarStore
+from surface_distance import surface_distance_masks
+from volume_cache import load_nifti
+
+# Where scoring tasks may read runs from.
+SOURCES = ('nifti', 'sidecar', 'archive')
+
+
+def score_base_image(task):
+    """
+    Score the given pairs of runs sharing a base image.
+
+    Each run volume is loaded exactly once, no matter how many pairs it
+    takes part in.  This is run in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        (root, source, base_image_id, runs, pairs, box, surface) where
+        source is 'nifti', 'sidecar' or 'archive' and says whether to read
+        the runs from the NIfTI files, through memory-mapped sidecar files
+        or from the bit-packed archive (see SOURCES), runs is a list of
+        (challenge_id, relative file path) tuples,
+        pairs is a list of (challenge_id1, challenge_id2) tuples to score,
+        box is a region of interest containing every run, or None, and
+        surface says whether to compute surface distances as well.  Only
+        the region of interest of each run is read and compared.
+
+    Returns
+    -------
+    results : list
+        One (base_image_id, challenge_id1, challenge_id2, OverlapResult,
+        SurfaceDistanceResult) tuple per pair of runs scored.  The surface
+        distances are None unless requested.
+    skipped : list
+        (challenge_id1, challenge_id2, reason) tuples for the pairs that
+        could not be compared.  Workers do not print, so that the output of
+        the parent process is not interleaved with messages.
+    """
+    root, source, base_image_id, runs, pairs, box, surface = task
+    if source == 'archive':
+        return score_packed(root, base_image_id, runs, pairs, box, surface)
+
+    loader = SidecarStore(root).load if source == 'sidecar' else load_nifti
+    index = roi.to_slices(box)
+
+    masks = {}
+    shapes = {}
+    voxel_volume = 1.0
+    spacing = (1.0, 1.0, 1.0)
+    for challenge_id, relfile in runs:
+        data, zooms = loader(os.path.join(root, relfile))
+        masks[challenge_id] = data[index] == 1
+        shapes[challenge_id] = data.shape
+        voxel_volume = float(np.prod(zooms[:3]))
+        spacing = zooms[:3]
+
+    results = []
+    skipped = []
+    for id1, id2 in pairs:
+        if shapes[id1] != shapes[id2]:
+            skipped.append((id1, id2, _shape_mismatch(shapes[id1],
+                                                      shapes[id2])))
+            continue
+        result = overlap_masks(masks[id1], masks[id2],
+                               voxel_volume=voxel_volume)
+        distances = None
+        if surface:
+            distances = surface_distance_masks(masks[id1], masks[id2],
+                                               spacing=spacing)
+        results.append((base_image_id, id1, id2, result, distances))
+    return results, skipped
+
+
+def _shape_mismatch(shape1, shape2):
+    return "shapes {0} and {1} differ".format(shape1, shape2)
+
+
+def report_skipped(skipped):
+    """
+    Report pairs that could not be compared on stderr.
+    """
+    msg = "Skipping challenge pair ({0}, {1}):  {2}\n"
+    for id1, id2, reason in skipped:
+        sys.stderr.write(msg.format(id1, id2, reason))
+
+
+def score_packed(root, base_image_id, runs, pairs, box, surface):
+    """
+    Score pairs of runs read from the bit-packed archive, see
+    score_base_image.  Overlap is counted on the packed bits; the masks are
+    only unpacked for surface distances.
+
+    Pairs involving a run that is missing from the archive, or that changed
+    since it was archived, are scored from the NIfTI files instead, so that
+    stale results never reach the metric cache.
+    """
+    archive = MaskArchive(root)
+    stale = set(challenge_id for challenge_id, relfile in runs
+                if not archive.is_current(relfile))
+    if len(stale) > 0:
+        fallback = [pair for pair in pairs
+                    if pair[0] in stale or pair[1] in stale]
+        pairs = [pair for pair in pairs if pair not in fallback]
+        needed = set(itertools.chain.from_iterable(fallback))
+        results, skipped = score_base_image(
+            (root, 'nifti', base_image_id,
+             [run for run in runs if run[0] in needed], fallback, box,
+             surface))
+    else:
+        results, skipped = [], []
+
+    needed = set(itertools.chain.from_iterable(pairs))
+    packed = dict((challenge_id, archive.get(relfile))
+                  for challenge_id, relfile in runs
+                  if challenge_id in needed)
+
+    for id1, id2 in pairs:
+        mask1, mask2 = packed[id1], packed[id2]
+        if mask1.shape != mask2.shape:
+            skipped.append((id1, id2, _shape_mismatch(mask1.shape,
+                                                      mask2.shape)))
+            continue
+        voxel_volume = float(np.prod(mask1.zooms))
+        result = overlap_packed(mask1, mask2, voxel_volume=voxel_volume)
+        distances = None
+        if surface:
+            distances = surface_distance_masks(mask1.unpack(), mask2.unpack(),
+                                               spacing=mask1.zooms)
+        results.append((base_image_id, id1, id2, result, distances))
+    return results, skipped
+
+
+def largest_first(tasks, repository):
+    """
+    Order scoring tasks by decreasing total size of their run files, so that
+    the biggest tasks do not end up running alone at the end of the job.
+    Run files without a recorded geometry count as empty.
+    """
+    relfiles = set(relfile for task in tasks for _, relfile in task[3])
+    geometries = repository.geometry(relfiles)
+
+    def size(task):
+        return sum(geometries[relfile].file_size
+                   for _, relfile in task[3] if relfile in geometries)
+
+    return sorted(tasks, key=size, reverse=True)
+
+
+class AgreementMatrix(object):
+    """
+    Attributes
+    ----------
+    root : str
+        Root directory where Nifty files are expected to be found.
+    processes : int
+        Number of worker processes.
+    source : str
+        Where runs are read from, one of SOURCES.
+    repository : Repository
+        Shared database connection.
+    conn, cursor : database connection objects
+    metric_cache : MetricCache
+        Pairwise metrics shared with the viewer.
+    files : dict
+        Relative run file path for each challenge id.
+    """
+    def __init__(self, root, processes=None, source='nifti', db=None):
+        self.repository = get_repository(db)
+        self.conn = self.repository.conn
+        self.cursor = self.conn.cursor()
+        self.root = root
+        self.processes = processes
+        self.source = source
+        self.metric_cache = MetricCache(self.repository, root)
+        self.files = {}
+
+    def __del__(self):
+        self.conn.commit()
+
+    def run(self):
+        self.create_agreement_table()
+
+        tasks, cached = self.collect_tasks()
+        self.store(cached, cache=False)
+
+        t0 = time.time()
+        num_scored = 0
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for results, skipped in pool.imap_unordered(score_base_image,
+                                                        tasks):
+                self.store(results)
+                report_skipped(skipped)
+                num_scored += len(results)
+        finally:
+            pool.close()
+            pool.join()
+        elapsed = time.time() - t0
+
+        msg = ("Scored {0} pairs over {1} base images in {2:.1f}s "
+               "({3:.1f} pairs/s), {4} pairs already cached")
+        rate = num_scored / elapsed if elapsed > 0 else float('inf')
+        print(msg.format(num_scored, len(tasks), elapsed, rate, len(cached)))
+
+    def create_agreement_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS agreement (
+                  challenge_id1     INTEGER,
+                  challenge_id2     INTEGER,
+                  base_image_id     INTEGER,
+                  size1             INTEGER,
+                  size2             INTEGER,
+                  intersection      INTEGER,
+                  dice              REAL,
+                  jaccard           REAL,
+                  sensitivity       REAL,
+                  precision         REAL,
+                  volume_difference REAL,
+                  PRIMARY KEY(challenge_id1, challenge_id2),
+                  FOREIGN KEY(challenge_id1) REFERENCES challenge(id),
+                  FOREIGN KEY(challenge_id2) REFERENCES challenge(id),
+                  FOREIGN KEY(base_image_id) REFERENCES base_image(id)
+              )
+              """
+        self.cursor.execute(sql)
+        self.conn.commit()
+
+    def collect_tasks(self):
+        """
+        Group the challenge runs by base image, one task per base image.
+
+        Pairs with valid cached metrics are not scored again.
+
+        Returns
+        -------
+        tasks : list
+            Arguments for score_base_image.
+        cached : list
+            Results retrieved from the metric cache.
+        """
+        sql = """
+              SELECT base_image_id, id, file FROM challenge
+              ORDER BY base_image_id, id
+              """
+        self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
+        boxes = self.repository.segmentation_rois(row[1] for row in rows)
+        tasks = []
+        cached = []
+        for base_image_id, group in itertools.groupby(rows, lambda r: r[0]):
+            runs = [(challenge_id, relfile) for _, challenge_id, relfile in group]
+            self.files.update(runs)
+
+            pairs = []
+            for (id1, file1), (id2, file2) in itertools.combinations(runs, 2):
+                result = self.metric_cache.lookup_overlap(id1, file1,
+                                                          id2, file2)
+                if result is None:
+                    pairs.append((id1, id2))
+                else:
+                    cached.append((base_image_id, id1, id2, result, None))
+
+            if len(pairs) > 0:
+                needed = set(itertools.chain.from_iterable(pairs))
+                runs = [run for run in runs if run[0] in needed]
+                box = roi.union(*[boxes.get(run[0]) for run in runs])
+                tasks.append((self.root, self.source, base_image_id, runs,
+                              pairs, box, False))
+        return largest_first(tasks, self.repository), cached
+
+    def store(self, results, cache=True):
+        """
+        Write results into the agreement table and, unless they came from
+        there in the first place, the metric cache.
+        """
+        sql = """
+              INSERT OR REPLACE INTO agreement VALUES
+              (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+              """
+        rows = [(id1, id2, base_image_id) + tuple(result)
+                for base_image_id, id1, id2, result, _ in results]
+        self.cursor.executemany(sql, rows)
+        self.conn.commit()
+
+        if not cache:
+            return
+        for _, id1, id2, result, _ in results:
+            self.metric_cache.store_overlap(id1, self.files[id1],
+                                            id2, self.files[id2], result)
+
+
+if __name__ == '__main__':
+
+    description = 'Compute all-pairs inter-run agreement'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('root', help='Data root')
+    parser.add_argument('--db', help='Database file')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes (default: all CPUs)')
+    parser.add_argument('--source', choices=SOURCES, default='nifti',
+                        help='Read runs from the NIfTI files (default), '
+                             'memory-mapped sidecar files or the bit-packed '
+                             'archive written by make_db.py')
+    parser.add_argument('--sidecar', dest='source', action='store_const',
+                        const='sidecar', help='Same as --source sidecar')
+
+    args = parser.parse_args()
+    o = AgreementMatrix(args.root, processes=args.processes,
+                        source=args.source, db=args.db)
+    o.run()
@@ -0,0 +1,353 @@
+"""
+Headless, resumable batch scoring of challenge run pairs.
+
+The comparisons to make are given by a manifest, a file with one JSON
+object per line, each being either an explicit pair of challenge IDs
+
+    {"pair": [12, 57]}
+
+or a query selecting all pairs of runs that share a base image
+
+    {"query": {"collection": "lidc", "team1": "stanford"}}
+
+A query may restrict by "collection", "label", "team1" and "team2".  The
+first run of each pair is taken from team1 and the second from team2; a
+missing team matches every team.  The same selection can be made on the
+command line with --pair, --collection, --label, --team1 and --team2.
+
+With --surface, the Hausdorff distance, its 95th percentile and the
+average symmetric surface distance are computed too, in mm.
+
+Results are streamed as CSV or JSON lines while the job runs.  With
+--checkpoint, every pair is recorded once its result has been written, and
+a restarted job skips the pairs already recorded.  Pairs that cannot be
+compared, e.g. because their runs differ in shape, are reported on stderr
+and recorded too.
+"""
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from agreement_matrix import (SOURCES, largest_first, report_skipped,
+                              score_base_image)
+from metric_cache import MetricCache
+from overlap import OverlapResult
+from repository import get_repository
+import roi
+from surface_distance import SurfaceDistanceResult
+
+COLUMNS = (['challenge_id1', 'challenge_id2', 'label']
+           + list(OverlapResult._fields)
+           + list(SurfaceDistanceResult._fields))
+_NO_DISTANCES = SurfaceDistanceResult(None, None, None)
+
+
+def read_manifest(path):
+    """
+    Parse a manifest file into a list of entries.
+    """
+    entries = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 0:
+                entries.append(json.loads(line))
+    return entries
+
+
+def pair_key(id1, id2):
+    """
+    Key identifying a comparison regardless of the order of its runs.
+    """
+    return min(id1, id2), max(id1, id2)
+
+
+def read_checkpoint(path):
+    """
+    Pairs already completed by an earlier run of the job, as pair keys.
+    """
+    done = set()
+    if path is None or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                done.add(pair_key(int(fields[0]), int(fields[1])))
+    return done
+
+
+class BatchScorer(object):
+    """
+    Attributes
+    ----------
+    root : str
+        Root directory where Nifty files are expected to be found.
+    processes : int
+        Number of worker processes.
+    source : str
+        Where runs are read from, one of agreement_matrix.SOURCES.
+    surface : bool
+        If true, compute surface distances as well as overlap.
+    repository : Repository
+        Shared database connection.
+    metric_cache : MetricCache
+        Pairwise metrics shared with the viewer.
+    """
+    def __init__(self, root, processes=None, source='nifti', db=None,
+                 surface=False):
+        self.root = root
+        self.processes = processes
+        self.source = source
+        self.surface = surface
+        self.repository = get_repository(db)
+        self.cursor = self.repository.conn.cursor()
+        self.metric_cache = MetricCache(self.repository, root)
+
+    def runs(self):
+        """
+        Every challenge run with its base image, label, collection and team.
+        """
+        sql = """
+              SELECT c.id, c.base_image_id, c.label, c.file,
+                     collection.name, team.team
+              FROM challenge c
+              INNER JOIN collection ON collection.id = c.collection_id
+              INNER JOIN team ON team.id = c.team_id
+              ORDER BY c.base_image_id, c.id
+              """
+        self.cursor.execute(sql)
+        return self.cursor.fetchall()
+
+    def select_pairs(self, entries):
+        """
+        Expand manifest entries into the list of challenge ID pairs to score.
+
+        Each pair keeps the order in which it was selected, i.e. the team1
+        run first, so that order-dependent metrics such as sensitivity are
+        oriented as requested.  A comparison selected more than once is
+        scored once, in the order it was first selected.
+
+        Raises
+        ------
+        ValueError
+            If an explicit pair names an unknown challenge ID.
+        """
+        runs = self.runs()
+        known = set(run[0] for run in runs)
+        by_base_image = [list(group) for _, group in
+                         itertools.groupby(runs, lambda run: run[1])]
+
+        pairs = []
+        keys = set()
+
+        def add(id1, id2):
+            if id1 != id2 and pair_key(id1, id2) not in keys:
+                keys.add(pair_key(id1, id2))
+                pairs.append((id1, id2))
+
+        for entry in entries:
+            if 'pair' in entry:
+                id1, id2 = [int(x) for x in entry['pair']]
+                for challenge_id in (id1, id2):
+                    if challenge_id not in known:
+                        msg = "unknown challenge ID {0} in pair ({1}, {2})"
+                        raise ValueError(msg.format(challenge_id, id1, id2))
+                add(id1, id2)
+                continue
+
+            query = entry['query']
+            for group in by_base_image:
+                group = [run for run in group
+                         if query.get('collection', run[4]) == run[4]
+                         and query.get('label', run[2]) == run[2]]
+                first = [run[0] for run in group
+                         if query.get('team1', run[5]) == run[5]]
+                second = [run[0] for run in group
+                          if query.get('team2', run[5]) == run[5]]
+                for id1, id2 in itertools.product(first, second):
+                    add(id1, id2)
+        return pairs
+
+    def make_tasks(self, pairs):
+        """
+        Split the pairs into cached results and one scoring task per base
+        image.
+
+        Pairs whose runs belong to different base images are scored in
+        their own task.
+        """
+        info = dict((run[0], run) for run in self.runs())
+        boxes = self.repository.segmentation_rois(
+            set(itertools.chain.from_iterable(pairs)))
+
+        cached = []
+        groups = {}
+        for id1, id2 in pairs:
+            file1, file2 = info[id1][3], info[id2][3]
+            result = self.metric_cache.lookup_overlap(id1, file1, id2, file2)
+            distances = None
+            if self.surface:
+                distances = self.metric_cache.lookup_surface_distance(
+                    id1, file1, id2, file2)
+            if result is not None and (distances is not None
+                                       or not self.surface):
+                cached.append((info[id1][1], id1, id2, result, distances))
+                continue
+            base_image_id = info[id1][1]
+            key = base_image_id if info[id2][1] == base_image_id else (id1, id2)
+            groups.setdefault(key, []).append((id1, id2))
+
+        tasks = []
+        for key, group in groups.items():
+            ids = sorted(set(itertools.chain.from_iterable(group)))
+            runs = [(challenge_id, info[challenge_id][3]) for challenge_id in ids]
+            box = roi.union(*[boxes.get(challenge_id) for challenge_id in ids])
+            tasks.append((self.root, self.source, info[group[0][0]][1], runs,
+                          group, box, self.surface))
+        return cached, largest_first(tasks, self.repository), info
+
+    def run(self, pairs, output, fmt='csv', checkpoint=None):
+        """
+        Score pairs of runs.
+
+        Parameters
+        ----------
+        pairs : list
+            Challenge ID pairs, see select_pairs.
+        output : file
+            Stream that results are written to as they complete.
+        fmt : str
+            'csv' or 'jsonl'.
+        checkpoint : str, optional
+            File recording completed pairs.
+        """
+        done = read_checkpoint(checkpoint)
+        pairs = [pair for pair in pairs if pair_key(*pair) not in done]
+        cached, tasks, info = self.make_tasks(pairs)
+
+        if fmt == 'csv':
+            writer = csv.writer(output)
+            if len(done) == 0:
+                writer.writerow(COLUMNS)
+        checkpoint_file = None
+        if checkpoint is not None:
+            checkpoint_file = open(checkpoint, 'a')
+
+        def emit(results, cache, skipped=()):
+            for _, id1, id2, result, distances in results:
+                row = ([id1, id2, info[id1][2]] + list(result)
+                       + list(distances or _NO_DISTANCES))
+                if fmt == 'csv':
+                    writer.writerow(row)
+                else:
+                    output.write(json.dumps(dict(zip(COLUMNS, row))) + '\n')
+                if cache:
+                    self.metric_cache.store_overlap(id1, info[id1][3],
+                                                    id2, info[id2][3], result)
+                if cache and distances is not None:
+                    self.metric_cache.store_surface_distance(
+                        id1, info[id1][3], id2, info[id2][3], distances)
+            output.flush()
+
+            report_skipped(skipped)
+
+            # Only record the pairs once their results are safely written.
+            if checkpoint_file is not None:
+                completed = ([(id1, id2) for _, id1, id2, _, _ in results]
+                             + [(id1, id2) for id1, id2, _ in skipped])
+                for id1, id2 in completed:
+                    checkpoint_file.write('{0} {1}\n'.format(id1, id2))
+                checkpoint_file.flush()
+
+        msg = "{0} pairs to score, {1} cached, {2} already done"
+        sys.stderr.write(msg.format(len(pairs) - len(cached), len(cached),
+                                    len(done)) + '\n')
+
+        emit(cached, cache=False)
+
+        t0 = time.time()
+        num_scored = 0
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for results, skipped in pool.imap_unordered(score_base_image,
+                                                        tasks):
+                emit(results, cache=True, skipped=skipped)
+                num_scored += len(results)
+        finally:
+            pool.close()
+            pool.join()
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+        elapsed = time.time() - t0
+
+        rate = num_scored / elapsed if elapsed > 0 else float('inf')
+        msg = "Scored {0} pairs in {1:.1f}s ({2:.1f} pairs/s)"
+        sys.stderr.write(msg.format(num_scored, elapsed, rate) + '\n')
+
+
+if __name__ == '__main__':
+
+    description = 'Score challenge run pairs without a display'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('root', help='Data root')
+    parser.add_argument('--db', help='Database file')
+    parser.add_argument('--manifest', help='JSON lines manifest of pairs')
+    parser.add_argument('--pair', nargs=2, type=int, action='append',
+                        default=[], metavar=('ID1', 'ID2'),
+                        help='Challenge ID pair to score (may be repeated)')
+    parser.add_argument('--collection', help='Select runs of a collection')
+    parser.add_argument('--label', help='Select runs of a base image')
+    parser.add_argument('--team1', help='Team of the first run of each pair')
+    parser.add_argument('--team2', help='Team of the second run of each pair')
+    parser.add_argument('--output', help='Output file (default: stdout)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], default='csv')
+    parser.add_argument('--checkpoint',
+                        help='File of completed pairs, used to resume')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='Number of worker processes (default: all CPUs)')
+    parser.add_argument('--source', choices=SOURCES, default='nifti',
+                        help='Read runs from the NIfTI files (default), '
+                             'memory-mapped sidecar files or the bit-packed '
+                             'archive written by make_db.py')
+    parser.add_argument('--sidecar', dest='source', action='store_const',
+                        const='sidecar', help='Same as --source sidecar')
+    parser.add_argument('--surface', action='store_true',
+                        help='Also compute surface distances (HD, HD95, ASSD)')
+
+    args = parser.parse_args()
+
+    entries = []
+    if args.manifest is not None:
+        entries.extend(read_manifest(args.manifest))
+    entries.extend({'pair': pair} for pair in args.pair)
+    query = dict((key, getattr(args, key))
+                 for key in ('collection', 'label', 'team1', 'team2')
+                 if getattr(args, key) is not None)
+    if len(query) > 0:
+        entries.append({'query': query})
+    if len(entries) == 0:
+        parser.error('no comparisons given')
+
+    o = BatchScorer(args.root, processes=args.processes,
+                    source=args.source, db=args.db, surface=args.surface)
+    try:
+        pairs = o.select_pairs(entries)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.output is None:
+        output = sys.stdout
+    else:
+        output = open(args.output, 'a')
+
+    try:
+        o.run(pairs, output, fmt=args.format, checkpoint=args.checkpoint)
+    finally:
+        if output is not sys.stdout:
+            output.close()
@@ -0,0 +1,362 @@
+"""
+Benchmarks of the load, score, contour, render and indexing hot paths.
+
+Synthetic base images and team runs of realistic size are written to a
+temporary data root, indexed with CtSegDB, and each hot path is timed a
+few times.  Base images are uncompressed NIfTI and runs are gzipped, as in
+the challenge data; memory-mapped sidecars of the runs are timed too.
+
+The results are written as JSON.  Given the results of an earlier run with
+--baseline, the script exits with status 1 if any median time got slower
+by more than --threshold.  It also fails if importing the viewer takes
+longer than --startup-target or pulls in nibabel, scipy, scikit-image or
+Pillow, which the viewer only needs once data is shown.
+
+    python benchmark.py --output new.json --baseline old.json
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import nibabel as nib
+import numpy as np
+
+from contours import slice_contour_points
+from make_db import CtSegDB
+from mask_archive import PackedMask, overlap_packed
+from overlap import overlap
+from planes import PLANES, plane_slice
+from repository import get_repository
+from rendering import GREEN, RED, SliceRenderer
+import roi
+from sidecar import SidecarStore
+from surface_distance import surface_distance
+from volume_cache import load_nifti
+
+# Modules imported by the viewer before its dialog is shown, apart from Qt
+# and the generated UI module.
+VIEWER_MODULES = ['confusion', 'consensus', 'contours', 'metric_cache',
+                  'overlap', 'planes', 'preview', 'repository', 'roi',
+                  'rendering', 'sidecar', 'surface_distance', 'tracing',
+                  'volume_cache']
+
+# Modules that the viewer should only import when they are first needed.
+HEAVY_MODULES = ['nibabel', 'scipy', 'skimage', 'PIL']
+
+SPACING = (0.7, 0.7, 1.25)
+COLLECTION = 'lidc'
+TEAM_IDS = (1, 2, 3)
+
+
+def ellipsoid(shape, center, radii):
+    """
+    Boolean mask of an axis-aligned ellipsoid, in voxels.
+    """
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    distance = sum(((x - c) / float(r)) ** 2
+                   for x, c, r in zip(grid, center, radii))
+    return distance <= 1
+
+
+def make_dataset(root, shapes, seed=0):
+    """
+    Write one base image with a run per team for each shape.
+
+    Returns
+    -------
+    list
+        (shape, base image path, run paths) tuples.
+    """
+    rng = np.random.RandomState(seed)
+    affine = np.diag(SPACING + (1.0,))
+    datasets = []
+    for shape in shapes:
+        label = 'L{0:04d}'.format(shape[2])
+        directory = os.path.join(root, COLLECTION, label)
+        os.makedirs(directory)
+
+        # A nodule of about 15 mm in noisy lung parenchyma.
+        center = [n // 2 for n in shape]
+        radii = [7.5 / s for s in SPACING]
+        base = rng.randint(-900, -700, size=shape).astype(np.int16)
+        base[ellipsoid(shape, center, radii)] += 800
+        base_path = os.path.join(root, COLLECTION, label + '.nii')
+        nib.save(nib.Nifti1Image(base, affine), base_path)
+
+        # Each team segments it a little differently.
+        run_paths = []
+        for team_id in TEAM_IDS:
+            jitter = rng.uniform(-0.15, 0.15, size=6)
+            run_center = [c + j * r for c, j, r in zip(center, jitter, radii)]
+            run_radii = [r * (1 + j) for r, j in zip(radii, jitter[3:])]
+            run = ellipsoid(shape, run_center, run_radii).astype(np.uint8)
+            name = 'alg{0:02d}_run1.nii.gz'.format(team_id)
+            run_path = os.path.join(directory, name)
+            nib.save(nib.Nifti1Image(run, affine), run_path)
+            run_paths.append(run_path)
+
+        datasets.append((shape, base_path, run_paths))
+    return datasets
+
+
+def measure(function, repeat):
+    """
+    Time repeated calls of a function, in seconds.
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = timeit.default_timer()
+        function()
+        times.append(timeit.default_timer() - t0)
+    return {'median': float(np.median(times)),
+            'min': float(min(times)),
+            'repeat': repeat}
+
+
+def measure_startup(repeat):
+    """
+    Time importing the viewer in a fresh interpreter.  The viewer module
+    itself is only imported if PyQt4 is available, otherwise the modules it
+    imports are.
+
+    The heavy modules pulled in by the import are listed in the result.
+    """
+    try:
+        import PyQt4
+        modules = ['call_ctSeg']
+    except ImportError:
+        modules = VIEWER_MODULES
+    code = ('import json, sys\n'
+            'import {0}\n'
+            'print(json.dumps([m for m in {1!r} if m in sys.modules]))')
+    command = [sys.executable, '-c',
+               code.format(', '.join(modules), HEAVY_MODULES)]
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    heavy = []
+
+    def start():
+        output = subprocess.check_output(command, cwd=cwd)
+        heavy[:] = json.loads(output.decode('utf-8'))
+
+    result = measure(start, repeat)
+    result['modules'] = modules
+    result['heavy_modules'] = heavy
+    return result
+
+
+def load_all(load, path):
+    """
+    Load a volume and touch every voxel, since uncompressed files may be
+    memory-mapped.
+    """
+    data, _ = load(path)
+    return data.max()
+
+
+def find_c3d():
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, 'c3d')
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Keep progress messages of the code under test out of the results.
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def run_benchmarks(workdir, shapes, repeat=5, seed=0):
+    """
+    Generate the data and database under a working directory and time
+    every hot path.
+
+    Returns
+    -------
+    dict
+        Timings keyed by benchmark name, see measure.
+    """
+    root = os.path.join(workdir, 'data')
+    datasets = make_dataset(root, shapes, seed=seed)
+    db = os.path.join(workdir, 'moist_challenge.db')
+    results = {}
+
+    results['startup.imports'] = measure_startup(repeat)
+
+    with quiet():
+        results['index.rebuild'] = measure(
+            lambda: CtSegDB(root, db=db).run(rebuild=True), repeat)
+        results['index.incremental'] = measure(
+            lambda: CtSegDB(root, db=db).run(), repeat)
+    repository = get_repository(db)
+    results['startup.collection_tree'] = measure(repository.collection_tree,
+                                                 repeat)
+
+    sidecars = SidecarStore(root)
+    c3d = find_c3d()
+    for shape, base_path, run_paths in datasets:
+        suffix = '[{0}]'.format('x'.join(str(n) for n in shape))
+        path1, path2 = run_paths[:2]
+        for path in run_paths:
+            sidecars.convert(path)
+
+        results['load.raw' + suffix] = measure(
+            lambda: load_all(load_nifti, base_path), repeat)
+        results['load.gz' + suffix] = measure(
+            lambda: load_all(load_nifti, path1), repeat)
+        results['load.sidecar' + suffix] = measure(
+            lambda: load_all(sidecars.load, path1), repeat)
+
+        base, _ = load_nifti(base_path)
+        base = np.asarray(base)
+        image1 = np.asarray(load_nifti(path1)[0])
+        image2 = np.asarray(load_nifti(path2)[0])
+        box = roi.union(roi.bounding_box(image1), roi.bounding_box(image2))
+
+        results['overlap.full' + suffix] = measure(
+            lambda: overlap(image1, image2), repeat)
+        results['overlap.roi' + suffix] = measure(
+            lambda: overlap(image1, image2, box=box), repeat)
+        packed1 = PackedMask.pack(image1 == 1)
+        packed2 = PackedMask.pack(image2 == 1)
+        results['overlap.packed' + suffix] = measure(
+            lambda: overlap_packed(packed1, packed2), repeat)
+        if c3d is not None:
+            command = [c3d, '-verbose', path1, path2, '-overlap', '1']
+            results['overlap.c3d' + suffix] = measure(
+                lambda: subprocess.check_output(command), repeat)
+        results['surface_distance.roi' + suffix] = measure(
+            lambda: surface_distance(image1, image2, spacing=SPACING,
+                                     box=box), repeat)
+
+        k = (box[2][0] + box[2][1]) // 2
+        results['contours.slice' + suffix] = measure(
+            lambda: slice_contour_points(image1[:, :, k], 0.8), repeat)
+
+        def contour_lesion():
+            (i0, i1), (j0, j1), (k0, k1) = roi.pad(box, 1, image1.shape)
+            for slice_number in range(k0, k1):
+                slice_contour_points(image1[i0:i1, j0:j1, slice_number], 0.8)
+        results['contours.lesion' + suffix] = measure(contour_lesion, repeat)
+
+        renderer = SliceRenderer()
+        overlays = [slice_contour_points(image1[:, :, k], 0.8) + (RED,),
+                    slice_contour_points(image2[:, :, k], 0.8) + (GREEN,)]
+        results['render.slice' + suffix] = measure(
+            lambda: renderer.render(base[:, :, k], overlays), repeat)
+
+        # The three planes through the lesion center, as in the viewer's
+        # multi-planar mode.
+        center = [(start + stop - 1) // 2 for start, stop in box]
+        renderers = dict((axis, SliceRenderer()) for axis in PLANES)
+
+        def render_planes():
+            for axis in PLANES:
+                image_slice = plane_slice(base, axis, center[axis])
+                renderers[axis].render(image_slice)
+        results['render.planes' + suffix] = measure(render_planes, repeat)
+
+    return results
+
+
+def regressions(results, baseline, threshold):
+    """
+    Benchmarks whose median time grew by more than the threshold, as
+    (name, baseline median, new median) tuples.
+    """
+    slower = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        old = baseline[name]['median']
+        if result['median'] > old * (1 + threshold):
+            slower.append((name, old, result['median']))
+    return slower
+
+
+if __name__ == '__main__':
+
+    description = 'Time the load, score, contour, render and index paths'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--size', type=int, default=512,
+                        help='In-plane size of the volumes')
+    parser.add_argument('--depths', type=int, nargs='+', default=[100, 400],
+                        help='Number of slices of each volume')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of times each benchmark is run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON results file (default: stdout)')
+    parser.add_argument('--baseline', help='JSON results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='Allowed slowdown relative to the baseline')
+    parser.add_argument('--startup-target', type=float, default=1.0,
+                        help='Allowed time in seconds to import the viewer')
+    parser.add_argument('--workdir',
+                        help='Directory for the synthetic data, kept '
+                             'afterwards (default: a temporary directory)')
+
+    args = parser.parse_args()
+
+    shapes = [(args.size, args.size, depth) for depth in args.depths]
+    workdir = args.workdir or tempfile.mkdtemp(prefix='ctseg-benchmark-')
+    try:
+        results = run_benchmarks(workdir, shapes, repeat=args.repeat,
+                                 seed=args.seed)
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir)
+
+    report = {'meta': {'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'nibabel': nib.__version__,
+                       'platform': platform.platform(),
+                       'shapes': shapes,
+                       'repeat': args.repeat,
+                       'seed': args.seed},
+              'results': results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+    failed = False
+    startup = results['startup.imports']
+    if startup['median'] > args.startup_target:
+        msg = "startup:  {0:.3f}s, target {1:.3f}s\n"
+        sys.stderr.write(msg.format(startup['median'], args.startup_target))
+        failed = True
+    if len(startup['heavy_modules']) > 0:
+        msg = "startup:  imports {0}\n"
+        sys.stderr.write(msg.format(', '.join(startup['heavy_modules'])))
+        failed = True
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        slower = regressions(results, baseline, args.threshold)
+        for name, old, new in slower:
+            msg = "{0}:  {1:.4f}s -> {2:.4f}s ({3:+.0%})\n"
+            sys.stderr.write(msg.format(name, old, new, new / old - 1))
+        failed = failed or len(slower) > 0
+
+    if failed:
+        sys.exit(1)
@@ -1,29 +1,165 @@
 # -*- coding:  utf-8 -*-
+import argparse
+import math
 import os
-import re
 import socket
-import sqlite3
-import subprocess
 import sys
-import tempfile
+import time
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from PyQt4 import QtCore, QtGui
-import nibabel as nib
-import skimage.measure
-import scipy.misc
 
+# nibabel, scipy, scikit-image and Pillow are only imported by these modules
+# when first needed, so that the dialog comes up quickly.
+from confusion import (confusion_matrix, is_probabilistic, sweep_summary,
+                       threshold_sweep)
+from consensus import CONSENSUS, ConsensusBuilder, consensus_id
+from contours import ContourCache
 from ctSeg import Ui_Dialog
+from metric_cache import MetricCache
+from overlap import overlap
+from planes import (AXIAL, CORONAL, NAMES, PLANES, SAGITTAL, Crosshair,
+                    in_plane_axes, pixel_scale, plane_slice)
+import preview
+from repository import get_repository
+import roi
+from rendering import GREEN, RED, LatencyRecorder, SliceRenderer
+from sidecar import SidecarStore
+from surface_distance import surface_distance
+import tracing
+from volume_cache import VolumeCache, load_nifti
+
+class ExecuteWorker(QtCore.QThread):
+    """
+    Load the run and base image volumes and score the runs off the Qt event
+    loop.
+
+    Any preparation steps, such as building a consensus, are run first.
+    The three volumes are then loaded concurrently.  Progress is reported with
+    the progress(QString, int) signal, the (OverlapResult,
+    SurfaceDistanceResult, ConfusionMatrix, sweep) tuple (or None if scoring
+    was not requested) with scored(PyQt_PyObject), and errors with
+    failed(QString).  Nothing is emitted after the worker is cancelled.
+    """
+    def __init__(self, volumes, pool, image_1, image_2, base_image,
+                 score=True, box=None, prepare=(), parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.volumes = volumes
+        self.pool = pool
+        self.image_1 = image_1
+        self.image_2 = image_2
+        self.base_image = base_image
+        self.score = score
+        self.box = box
+        self.prepare = prepare
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def progress(self, stage, percent):
+        if not self.cancelled:
+            self.emit(QtCore.SIGNAL('progress(QString, int)'), stage, percent)
+
+    def run(self):
+        try:
+            with tracing.span('execute.worker'):
+                result = self.load_and_score()
+        except Exception as e:
+            if not self.cancelled:
+                self.emit(QtCore.SIGNAL('failed(QString)'), str(e))
+            return
+        if not self.cancelled:
+            self.emit(QtCore.SIGNAL('scored(PyQt_PyObject)'), result)
+
+    def load_and_score(self):
+        for n, step in enumerate(self.prepare):
+            self.progress('Preparing', 100 * n // len(self.prepare))
+            with tracing.span('execute.prepare'):
+                step()
+            if self.cancelled:
+                return None
+
+        paths = [self.image_1, self.image_2, self.base_image]
+        self.progress('Loading', 0)
+        with tracing.span('execute.load'):
+            pending = [self.pool.apply_async(self.volumes.get, (path,))
+                       for path in paths]
+            for n, result in enumerate(pending):
+                result.get()
+                if self.cancelled:
+                    return None
+                self.progress('Loading', 100 * (n + 1) // len(paths))
+
+        if not self.score:
+            return None
+
+        self.progress('Scoring', 0)
+        zooms = self.volumes.get_zooms(self.image_1)
+        voxel_volume = float(np.prod(zooms[:3]))
+        image_1 = self.volumes.get(self.image_1)
+        image_2 = self.volumes.get(self.image_2)
+        with tracing.span('score.overlap', box=self.box):
+            result = overlap(image_1, image_2, label=1,
+                             voxel_volume=voxel_volume, box=self.box)
+        self.progress('Scoring', 33)
+        with tracing.span('score.surface_distance', box=self.box):
+            distances = surface_distance(image_1, image_2, label=1,
+                                         spacing=zooms[:3], box=self.box)
+        self.progress('Scoring', 67)
+
+        # Probability maps are swept over thresholds, label maps get the
+        # confusion matrix of all their labels.
+        confusion = sweep = None
+        if (is_probabilistic(image_1, self.box)
+                or is_probabilistic(image_2, self.box)):
+            with tracing.span('score.threshold_sweep', box=self.box):
+                sweep = threshold_sweep(image_1, image_2,
+                                        voxel_volume=voxel_volume,
+                                        box=self.box)
+        else:
+            with tracing.span('score.confusion', box=self.box):
+                confusion = confusion_matrix(image_1, image_2, box=self.box)
+        self.progress('Scoring', 100)
+        return result, distances, confusion, sweep
+
 
 class MyForm(QtGui.QDialog):
     """
     Attributes
     ----------
+    max_fps : float
+        Cap on the rate at which slices are redrawn while scrubbing.
     label : str
         Label identifying the base image currently active.  May be something
         like L0013.
+    repository : Repository
+        Shared connection to the moist challenge database.
     conn, cursor : database connection objects
+    consensus : ConsensusBuilder
+        Majority-vote consensus of all runs of a base image, offered as an
+        extra entry in both run combo boxes.
+    contours : ContourCache
+        Run contours, prefetched outwards from the current slice.
+    crosshair : Crosshair or None
+        Position shown by the three planes in multi-planar mode.  None
+        while only the axial plane is shown.
+    worker : ExecuteWorker or None
+        Background job loading and scoring a new selection, which is staged
+        in its selection attribute until the job finishes.
+    pending_slice : int or None
+        Latest slice requested by the slider that has not been drawn yet.
+    render_latency : LatencyRecorder
+        Time taken by each slice redraw.
+    volumes : VolumeCache
+        Run and base image volumes, shared by all views of the data.  The
+        memory budget in MB may be set with the CTSEG_VOLUME_CACHE_MB
+        environment variable.  If CTSEG_SIDECAR is set, gzipped runs are
+        read through memory-mapped sidecar files.
     """
+    max_fps = 60.0
+
     def __init__(self, parent=None):
         """
         """
@@ -36,280 +172,689 @@ class MyForm(QtGui.QDialog):
         self.ui = Ui_Dialog()
         self.ui.setupUi(self)
 
-        self.setup_c3d_environment()
         self.setup_database()
 
-        self.setupCollectionTree()
+        if os.environ.get('CTSEG_SIDECAR'):
+            store = SidecarStore(self.dataroot, repository=self.repository)
+            loader = store.load
+        else:
+            loader = load_nifti
+        max_mb = int(os.environ.get('CTSEG_VOLUME_CACHE_MB', 1024))
+        self.volumes = VolumeCache(max_bytes=max_mb * 1024 ** 2,
+                                   loader=loader)
+        self.contours = ContourCache(self.volumes)
+        self.consensus = ConsensusBuilder(self.dataroot, self.repository,
+                                          loader=loader)
+        self.load_pool = ThreadPool(3)
+        self.worker = None
+        self.setup_plane_views()
+
+        # Fill the tree once the dialog has been shown.
+        QtCore.QTimer.singleShot(0, self.setupCollectionTree)
 
         # When the execute button is pressed, initiate image processing.
         QtCore.QObject.connect(self.ui.executeButton,
                                QtCore.SIGNAL('clicked()'),
                                self.execute)
 
-        # When the slider is changed, load a new slice.
-        #self.ui.imageSliceSlider.valueChanged.connect(self.load_new_slice)
+        # When the slider is changed, load a new slice.  Redraws are
+        # coalesced so that only the latest slice is drawn, at most max_fps
+        # times per second.
+        self.pixmap_item = None
+        self.pending_slice = None
+        self.last_render = 0.0
+        self.render_latency = LatencyRecorder()
+        self.render_timer = QtCore.QTimer(self)
+        self.render_timer.setSingleShot(True)
+        QtCore.QObject.connect(self.render_timer, QtCore.SIGNAL('timeout()'),
+                               self.render_pending_slice)
+        QtCore.QObject.connect(self.ui.imageSliceSlider,
+                               QtCore.SIGNAL('valueChanged(int)'),
+                               self.request_slice)
         QtCore.QObject.connect(self.ui.imageSliceSlider,
                                QtCore.SIGNAL('sliderReleased()'),
                                self.load_new_slice)
 
 
+    def request_slice(self, slice_number):
+        """
+        The slider moved.  Draw the slice right away if its contours are
+        cached and the frame budget allows, otherwise on the next frame.
+        """
+        if self.pixmap_item is None:
+            return
+        self.pending_slice = slice_number
+
+        wait = 1.0 / self.max_fps - (time.time() - self.last_render)
+        cached = all((path, AXIAL, slice_number, 0.8) in self.contours
+                     for path in (self.image_1, self.image_2))
+        if cached and wait <= 0:
+            self.render_timer.stop()
+            self.render_pending_slice()
+        elif not self.render_timer.isActive():
+            self.render_timer.start(max(0, int(wait * 1000)))
+
+    def render_pending_slice(self):
+        if self.pending_slice is None or self.pixmap_item is None:
+            return
+        slice_number, self.pending_slice = self.pending_slice, None
+
+        t0 = time.time()
+        self.display_image_slice(slice_number)
+        self.last_render = time.time()
+        self.render_latency.record(self.last_render - t0)
+
     def load_new_slice(self):
         """
-        When the slider is changed, we load a new slice.
+        When the slider is released, refocus contour prefetching on the
+        new slice.
         """
+        if self.pixmap_item is None:
+            return
         slice_number = self.ui.imageSliceSlider.sliderPosition()
-        self.display_image_slice(slice_number)
+        self.prefetch_contours(slice_number)
+
+    def prefetch_contours(self, slice_number):
+        """
+        Extract the run contours in the background, moving outwards from
+        the given slice.
+        """
+        depth = self.volumes.get(self.base_image).shape[2]
+        self.contours.prefetch([self.image_1, self.image_2], slice_number,
+                               depth, 0.8)
 
 
     def setup_database(self):
         """
         """
-        self.conn = sqlite3.connect('moist_challenge.db')
-        self.cursor = self.conn.cursor()
+        self.repository = get_repository()
+        self.conn = self.repository.conn
+        self.cursor = self.repository.cursor
+        self.metric_cache = MetricCache(self.repository, self.dataroot)
 
-    def setup_c3d_environment(self):
+    def cancel_execute(self):
         """
-        Setup paths to be able to run C3D.
+        Abandon the background job for the previous selection, if any.
         """
-        # Add some common paths to the c3d executable
-        # First is on HubZero, 2nd is Mac with gui installation, 3rd is 
-        # MGH getafix.
-        paths = ['/apps/share64/debian7/convert3d/nightly',
-                 '/Applications/Convert3DGUI.app/Contents/bin',
-                 '/space/getafix/1/users/jevans/c3d-1.0.0-Linux-x86_64/bin']
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
 
-        env = dict(os.environ)
-        env['PATH'] = os.environ['PATH']
-        for path in paths:
-            env['PATH'] = env['PATH'] + ':' + path
-        self.env = env
-
-    def run_c3d(self):
+    def is_current_worker(self):
         """
-        Drive c3d, obtain dice similarity coefficient between the two images.
+        True if the signal being handled comes from the current worker
+        rather than one that was cancelled after emitting it.
         """
-        # Want to match the output of the c3d command against the pattern
-        # "Dice similarity coefficient:   \d*.\d*"
-        #
-        # Possibilities are any of the following:
-        #     Dice similarity coefficient:   -nan
-        #     Dice similarity coefficient:   1
-        #     Dice similarity coefficient:   0.8243
-        pattern = r"""Dice\ssimilarity\scoefficient:\s*
-                      (?P<dice>-nan|\d(.\d*){0,1})"""
-        regex = re.compile(pattern, re.VERBOSE)
+        return self.worker is not None and self.sender() is self.worker
 
-        command = 'c3d -verbose {image1} {image2} -overlap 1'
-        command = command.format(image1=self.image_1, image2=self.image_2)
-        print(command)
-        self.c3d_output = command
-        self.c3d_output += '\n'
-        output = subprocess.check_output(command.split(' '), env=self.env)
-        matchobj = regex.search(output)
-        print(float(matchobj.group('dice')))
-        self.ui.diceLabel.setText(matchobj.group())
-        return float(matchobj.group('dice'))
+    def execute_progress(self, stage, percent):
+        if not self.is_current_worker():
+            return
+        self.ui.diceLabel.setText('{0}... {1}%'.format(stage, percent))
 
+    def execute_failed(self, message):
+        if not self.is_current_worker():
+            return
+        self.worker = None
+        self.ui.diceLabel.setText('Failed:  {0}'.format(message))
 
-    def execute(self):
+    def execute_finished(self, result):
         """
-        Call C3D, get the dice coefficient.
-        """
-        # What run images were chosen?
-        idx1 = self.ui.team1ComboBox.currentIndex()
-        idx2 = self.ui.team2ComboBox.currentIndex()
-        print("idx1 = ", idx1)
-        print("idx2 = ", idx2)
-
-        qvar = self.ui.team1ComboBox.itemData(idx1, role=QtCore.Qt.UserRole)
-        challenge_id1 = int(qvar.toString())
-        qvar = self.ui.team1ComboBox.itemData(idx2, role=QtCore.Qt.UserRole)
-        challenge_id2 = int(qvar.toString())
-
-        conn = sqlite3.connect('moist_challenge.db')
-        c = conn.cursor()
-        sql = """
-              SELECT file FROM challenge
-              WHERE id = ? 
-              """
-        c.execute(sql, (challenge_id1,))
-        print(sql, challenge_id1)
-
-        row = c.fetchone()
-        file1 = row[0]
-
-
-        sql = """
-              SELECT file FROM challenge
-              WHERE id = ?
-              """
-        c.execute(sql, (challenge_id2,))
-        print(sql, challenge_id2)
-
-        row = c.fetchone()
-        file2 = row[0]
-        print("file1 = ", file1)
-        print("file2 = ", file2)
-        self.image_1 = os.path.join(self.dataroot, file1)
-        self.image_2 = os.path.join(self.dataroot, file2)
-        print("loading {}".format(self.image_1))
-        self.image1_data = nib.load(self.image_1).get_data()
-        print("loading {}".format(self.image_2))
-        self.image2_data = nib.load(self.image_2).get_data()
-        flt = self.run_c3d()
-
+        The volumes are loaded and, unless they were cached, the overlap
+        and surface distances are scored.  Show the results.
+        """
+        if not self.is_current_worker():
+            return
+        selection = self.worker.selection
+        self.worker = None
+        self.commit_selection(selection)
+        if result is not None:
+            self.overlap, self.distances, self.confusion, self.sweep = result
+        if result is not None and min(self.challenge_id1,
+                                      self.challenge_id2) > 0:
+            self.metric_cache.store_overlap(self.challenge_id1, self.file1,
+                                            self.challenge_id2, self.file2,
+                                            self.overlap)
+            self.metric_cache.store_surface_distance(self.challenge_id1,
+                                                     self.file1,
+                                                     self.challenge_id2,
+                                                     self.file2,
+                                                     self.distances)
+            if self.confusion is not None:
+                self.metric_cache.store_confusion(self.challenge_id1,
+                                                  self.file1,
+                                                  self.challenge_id2,
+                                                  self.file2,
+                                                  self.confusion)
+            if self.sweep is not None:
+                self.metric_cache.store_sweep(self.challenge_id1, self.file1,
+                                              self.challenge_id2, self.file2,
+                                              self.sweep)
+        tracing.instant('execute.result', overlap=self.overlap._asdict(),
+                        distances=self.distances._asdict())
+        lines = [self.overlap.summary(), self.distances.summary()]
+        if self.sweep is not None:
+            lines.append(sweep_summary(self.sweep))
+        elif self.confusion is not None and len(self.confusion.dice()) > 1:
+            lines.append(self.confusion.summary())
+        self.ui.diceLabel.setText('\n'.join(lines))
+
+        if len(self.render_latency.samples) > 0:
+            tracing.instant('render.latency',
+                            summary=self.render_latency.summary())
         self.setupBaseImage()
 
+
+    @tracing.traced('execute')
+    def execute(self):
+        """
+        Load the two run images, get the dice coefficient.
+
+        The loading and scoring are done by a background worker, see
+        execute_finished.
+        """
+        # What run images were chosen?  The consensus is identified by a
+        # stand-in challenge ID and is built by the worker if necessary.
+        base_image_id = self.repository.base_image_id(str(self.label))
+        prepare = []
+        selected = []
+        for combobox in (self.ui.team1ComboBox, self.ui.team2ComboBox):
+            idx = combobox.currentIndex()
+            qvar = combobox.itemData(idx, role=QtCore.Qt.UserRole)
+            if str(qvar.toString()) == CONSENSUS:
+                relfile = self.consensus.consensus_file(base_image_id)
+                selected.append((consensus_id(base_image_id), relfile))
+                # A rebuilt consensus replaces the file; the volume cache
+                # notices by its mtime, the contours are dropped here.
+                path = os.path.join(self.dataroot, relfile)
+                prepare = [lambda: self.consensus.update(base_image_id),
+                           lambda: self.contours.discard(path)]
+            else:
+                challenge_id = int(qvar.toString())
+                relfile = self.repository.challenge_file(challenge_id)
+                selected.append((challenge_id, relfile))
+        (challenge_id1, file1), (challenge_id2, file2) = selected
+        tracing.instant('execute.selection', file1=file1, file2=file2)
+
+        # The selection is staged on the worker and only made current by
+        # execute_finished, once its volumes are loaded.  Until then, and
+        # if the worker is cancelled, the previous selection stays intact.
+        filepath = self.repository.base_image_file(str(self.label))
+        selection = {'challenge_id1': challenge_id1, 'file1': file1,
+                     'challenge_id2': challenge_id2, 'file2': file2,
+                     'image_1': os.path.join(self.dataroot, file1),
+                     'image_2': os.path.join(self.dataroot, file2),
+                     'base_image': os.path.join(self.dataroot, filepath)}
+
+        # Reject images that cannot be compared voxel for voxel before
+        # reading any voxel data.  Geometry comes from the headers indexed
+        # by make_db.py; the consensus is not indexed and is not checked.
+        geometries = self.repository.geometry([file1, file2, filepath])
+        known = [(relfile, geometries[relfile])
+                 for relfile in (filepath, file1, file2)
+                 if relfile in geometries]
+        for relfile, geometry in known[1:]:
+            if not geometry.matches(known[0][1]):
+                msg = 'Failed:  geometry of {0} does not match {1}'
+                self.ui.diceLabel.setText(msg.format(relfile, known[0][0]))
+                return
+        selection['base_geometry'] = geometries.get(filepath)
+
+        # The selection is valid, so abandon the previous one.  Stop
+        # scrubbing through the previous pair until this one is ready.
+        self.cancel_execute()
+        self.clear_planes()
+        self.pixmap_item = None
+
+        # The consensus may be rebuilt by the worker, so it is not looked
+        # up in the metric cache.
+        if len(prepare) == 0:
+            key = (challenge_id1, file1, challenge_id2, file2)
+            selection.update(
+                overlap=self.metric_cache.lookup_overlap(*key),
+                distances=self.metric_cache.lookup_surface_distance(*key),
+                confusion=self.metric_cache.lookup_confusion(*key),
+                sweep=self.metric_cache.lookup_sweep(*key))
+        else:
+            selection.update(overlap=None, distances=None, confusion=None,
+                             sweep=None)
+
+        # Restrict scoring and contouring to where the runs are nonempty.
+        boxes = self.repository.segmentation_rois([challenge_id1,
+                                                   challenge_id2])
+        selection['boxes'] = (boxes.get(challenge_id1),
+                              boxes.get(challenge_id2))
+        selection['box'] = roi.union(*selection['boxes'])
+
+        score = (selection['overlap'] is None
+                 or selection['distances'] is None
+                 or (selection['confusion'] is None
+                     and selection['sweep'] is None))
+        self.worker = ExecuteWorker(self.volumes, self.load_pool,
+                                    selection['image_1'],
+                                    selection['image_2'],
+                                    selection['base_image'],
+                                    score=score, box=selection['box'],
+                                    prepare=prepare, parent=self)
+        self.worker.selection = selection
+        QtCore.QObject.connect(self.worker,
+                               QtCore.SIGNAL('progress(QString, int)'),
+                               self.execute_progress)
+        QtCore.QObject.connect(self.worker,
+                               QtCore.SIGNAL('scored(PyQt_PyObject)'),
+                               self.execute_finished)
+        QtCore.QObject.connect(self.worker,
+                               QtCore.SIGNAL('failed(QString)'),
+                               self.execute_failed)
+        QtCore.QObject.connect(self.worker, QtCore.SIGNAL('finished()'),
+                               self.worker.deleteLater)
+        self.worker.start()
+
+    def commit_selection(self, selection):
+        """
+        Make the selection staged by execute current.  Its volumes have
+        been loaded by the worker.
+        """
+        self.challenge_id1 = selection['challenge_id1']
+        self.challenge_id2 = selection['challenge_id2']
+        self.file1 = selection['file1']
+        self.file2 = selection['file2']
+        self.image_1 = selection['image_1']
+        self.image_2 = selection['image_2']
+        self.base_image = selection['base_image']
+        self.base_geometry = selection['base_geometry']
+        self.box = selection['box']
+        self.overlap = selection['overlap']
+        self.distances = selection['distances']
+        self.confusion = selection['confusion']
+        self.sweep = selection['sweep']
+        box1, box2 = selection['boxes']
+        self.contours.set_box(self.image_1, box1)
+        self.contours.set_box(self.image_2, box2)
+
+    @tracing.traced('render.slice')
     def display_image_slice(self, slice_number):
         """
+        Render an axial slice of the base image with the contours of both
+        runs.  In multi-planar mode the crosshair follows the slice.
+        """
+        if self.crosshair is not None:
+            self.crosshair.move(AXIAL, slice_number)
+            self.update_crosshair()
+        self.render_plane(AXIAL, slice_number)
+
+    def render_plane(self, axis, slice_number):
+        """
+        Render a slice across the given axis of the base image with the
+        contours of both runs.  The slice is a view of the cached volume.
 
         Reference
         ---------
         scikit-image.org/docs/dev/auto_examples/plot_contours.html#example-plot-contours.py
         """
-        height, width, depth = self.image_data.shape
-
-        # Retrieve user image contours at the specified slice.
-        slice_contours_1 = skimage.measure.find_contours(self.image1_data[:, :, slice_number], 0.8)
-        slice_contours_2 = skimage.measure.find_contours(self.image2_data[:, :, slice_number], 0.8)
-
-        image_slice = scipy.misc.bytescale(self.image_data[:,:,slice_number])
-        faux_3d = np.zeros((height, width, 3))
-        faux_3d[:,:,0] = image_slice
-        faux_3d[:,:,1] = image_slice
-        faux_3d[:,:,2] = image_slice
-
-        # Color user image 1 contours as red
-        for contour in slice_contours_1:
-            rows = contour[:,0].round().astype(np.int32)
-            cols = contour[:,1].round().astype(np.int32)
-            faux_3d[rows, cols, 0] = 0
-            faux_3d[rows, cols, 1] = 0
-            faux_3d[rows, cols, 2] = 255
-
-        # Color user image 2 contours as green
-        for contour in slice_contours_2:
-            rows = contour[:,0].round().astype(np.int32)
-            cols = contour[:,1].round().astype(np.int32)
-            faux_3d[rows, cols, 0] = 0
-            faux_3d[rows, cols, 1] = 255
-            faux_3d[rows, cols, 2] = 0
-
-        with tempfile.NamedTemporaryFile(suffix='.png') as tfile:
-            scipy.misc.imsave(tfile.name, np.flipud(faux_3d.T))
-            tfile.flush()
-
-            qimage = QtGui.QImage(tfile.name)
-
-        pixmap = QtGui.QPixmap(qimage)
-
-        # QGraphicsView.fitInView()?
-        myScaledPixmap = pixmap.scaled(self.ui.graphicsView.size(), QtCore.Qt.KeepAspectRatio)
-        self.scene.addPixmap(myScaledPixmap)
-        self.scene.update()
+        image_data = self.volumes.get(self.base_image)
+
+        # Retrieve user image contours at the specified slice.  Color user
+        # image 1 contours as red, user image 2 contours as green.
+        with tracing.span('render.contours', slice_number=slice_number,
+                          plane=NAMES[axis]):
+            rows1, cols1 = self.contours.get(self.image_1, slice_number, 0.8,
+                                             axis)
+            rows2, cols2 = self.contours.get(self.image_2, slice_number, 0.8,
+                                             axis)
+        overlays = [(rows1, cols1, RED), (rows2, cols2, GREEN)]
+
+        with tracing.span('render.rgb', plane=NAMES[axis]):
+            image_slice = plane_slice(image_data, axis, slice_number)
+            rgb = self.renderers[axis].render(image_slice, overlays)
+
+        # The QImage wraps the render buffer without copying it.
+        with tracing.span('render.pixmap', plane=NAMES[axis]):
+            height, width = rgb.shape[:2]
+            qimage = QtGui.QImage(rgb.data, width, height, rgb.strides[0],
+                                  QtGui.QImage.Format_RGB888)
+            if axis == AXIAL:
+                item = self.pixmap_item
+            else:
+                item = self.plane_items[axis]
+            item.setPixmap(QtGui.QPixmap.fromImage(qimage))
+
+
+    def setup_slider(self, depth):
+        """
+        Set the slider range.  Allow the user to look thru all slices, but
+        start in the middle of the lesion if its extent is known.
 
+        Returns
+        -------
+        int
+            The starting slice number.
+        """
+        if self.box is None or self.box == roi.EMPTY:
+            slice_number = 0
+        else:
+            kstart, kstop = self.box[2]
+            slice_number = (kstart + kstop - 1) // 2
+        self.ui.imageSliceSlider.setMinimum(0)
+        self.ui.imageSliceSlider.setMaximum(depth-1)
+        self.ui.imageSliceSlider.setValue(slice_number)
+        return slice_number
 
+    @tracing.traced('execute.setup_view')
     def setupBaseImage(self):
         """
+        Show the base image chosen in execute, which has already been loaded.
         """
-        sql = """
-              SELECT file FROM base_image
-              WHERE label = ?
-              """
-        self.cursor.execute(sql, (str(self.label),))
-        row = self.cursor.fetchone()
-        filepath = row[0]
-        img = nib.load(os.path.join(self.dataroot, filepath))
-        self.image_data = img.get_data()
-
-        height, width, depth = self.image_data.shape
-
-        # Set the slider range.  Allow the user to look thru all slices.
-        self.ui.imageSliceSlider.setMinimum(0)
-        self.ui.imageSliceSlider.setMaximum(depth-1)
+        if self.base_geometry is None:
+            depth = self.volumes.get(self.base_image).shape[2]
+        else:
+            depth = self.base_geometry.shape[2]
+        tracing.instant('volume_cache.stats', summary=self.volumes.stats())
+        slice_number = self.setup_slider(depth)
 
+        self.clear_planes()
         self.scene = QtGui.QGraphicsScene(self)
         self.ui.graphicsView.setScene(self.scene)
+        self.renderers = dict((axis, SliceRenderer()) for axis in PLANES)
+        self.pixmap_item = self.scene.addPixmap(QtGui.QPixmap())
+
+        self.display_image_slice(slice_number)
+        self.ui.graphicsView.fitInView(self.pixmap_item,
+                                       QtCore.Qt.KeepAspectRatio)
+        if self.multiplanarCheckBox.isChecked():
+            self.setup_planes()
+        self.prefetch_contours(slice_number)
 
-        self.display_image_slice(0)
-        
+    def setup_plane_views(self):
+        """
+        Add the coronal and sagittal views below the axial one, and the
+        check box showing them.  They stay hidden until multi-planar mode is
+        chosen.
+        """
+        self.crosshair = None
+        self.plane_items = {}
+        self.crosshair_lines = {}
+
+        self.multiplanarCheckBox = QtGui.QCheckBox('Multi-planar',
+                                                   self.ui.layoutWidget)
+        self.ui.verticalLayout.addWidget(self.multiplanarCheckBox)
+        QtCore.QObject.connect(self.multiplanarCheckBox,
+                               QtCore.SIGNAL('toggled(bool)'),
+                               self.set_multiplanar)
+
+        self.plane_views = {AXIAL: self.ui.graphicsView}
+        layout = QtGui.QHBoxLayout()
+        for axis in (CORONAL, SAGITTAL):
+            view = QtGui.QGraphicsView(QtGui.QGraphicsScene(self),
+                                       self.ui.layoutWidget1)
+            view.hide()
+            layout.addWidget(view)
+            self.plane_views[axis] = view
+        self.ui.verticalLayout_2.insertLayout(1, layout)
+
+        # Clicks in any of the views move the crosshair, see eventFilter.
+        # The viewports are kept so that they can be recognized there.
+        self.plane_viewports = {}
+        for axis, view in self.plane_views.items():
+            self.plane_viewports[axis] = view.viewport()
+            self.plane_viewports[axis].installEventFilter(self)
+
+    def set_multiplanar(self, checked):
+        """
+        The multi-planar check box was toggled.
+        """
+        tracing.instant('planes.toggle', checked=checked)
+        for axis in (CORONAL, SAGITTAL):
+            self.plane_views[axis].setVisible(checked)
+        if not checked:
+            self.clear_planes()
+        elif self.pixmap_item is not None:
+            self.setup_planes()
+
+    @tracing.traced('planes.setup')
+    def setup_planes(self):
+        """
+        Show the coronal and sagittal planes through the middle of the
+        lesion and the current axial slice, and mark the crosshair in all
+        three planes.  The base image has already been loaded.
+        """
+        image_data = self.volumes.get(self.base_image)
+        zooms = self.volumes.get_zooms(self.base_image)
+        if self.box is None or self.box == roi.EMPTY:
+            position = None
+        else:
+            position = [(start + stop - 1) // 2 for start, stop in self.box]
+        self.crosshair = Crosshair(image_data.shape, position)
+        self.crosshair.move(AXIAL, self.ui.imageSliceSlider.value())
+
+        pen = QtGui.QPen(QtGui.QColor(255, 255, 0))
+        pen.setCosmetic(True)
+        self.plane_items = {AXIAL: self.pixmap_item}
+        for axis in (CORONAL, SAGITTAL):
+            scene = self.plane_views[axis].scene()
+            scene.clear()
+            self.plane_items[axis] = scene.addPixmap(QtGui.QPixmap())
+        for axis, item in self.plane_items.items():
+            # Show thick slices stretched to their true size.
+            sx, sy = pixel_scale(zooms, axis)
+            item.setTransform(QtGui.QTransform.fromScale(sx, sy))
+            lines = [QtGui.QGraphicsLineItem(item) for _ in range(2)]
+            for line in lines:
+                line.setPen(pen)
+            self.crosshair_lines[axis] = lines
+
+        for axis in (CORONAL, SAGITTAL):
+            self.render_plane(axis, self.crosshair.slice_number(axis))
+        self.update_crosshair()
+        for axis, item in self.plane_items.items():
+            self.plane_views[axis].fitInView(item, QtCore.Qt.KeepAspectRatio)
+
+    def clear_planes(self):
+        """
+        Remove the coronal and sagittal planes and the crosshair.
+        """
+        for lines in self.crosshair_lines.values():
+            for line in lines:
+                if line.scene() is not None:
+                    line.scene().removeItem(line)
+        if self.pixmap_item is not None:
+            self.pixmap_item.setTransform(QtGui.QTransform())
+        for axis in (CORONAL, SAGITTAL):
+            self.plane_views[axis].scene().clear()
+        self.crosshair = None
+        self.plane_items = {}
+        self.crosshair_lines = {}
+
+    def update_crosshair(self):
+        """
+        Move the crosshair lines of every plane to the current position.
+        """
+        for axis, (vertical, horizontal) in self.crosshair_lines.items():
+            width, height = [self.crosshair.shape[a]
+                             for a in in_plane_axes(axis)]
+            x, y = self.crosshair.point(axis)
+            vertical.setLine(x + 0.5, 0, x + 0.5, height)
+            horizontal.setLine(0, y + 0.5, width, y + 0.5)
+
+    def eventFilter(self, watched, event):
+        """
+        In multi-planar mode, a click in any plane moves the crosshair to
+        the voxel clicked.
+        """
+        if (event.type() == QtCore.QEvent.MouseButtonPress
+                and self.crosshair is not None):
+            for axis, item in self.plane_items.items():
+                view = self.plane_views[axis]
+                if watched is self.plane_viewports[axis]:
+                    point = item.mapFromScene(view.mapToScene(event.pos()))
+                    self.crosshair_clicked(axis, point.x(), point.y())
+                    return True
+        return QtGui.QDialog.eventFilter(self, watched, event)
+
+    @tracing.traced('planes.click')
+    def crosshair_clicked(self, axis, x, y):
+        """
+        Move the other planes through a pixel clicked in one plane.  The
+        volume and contours are already in memory, so only the planes that
+        changed are redrawn.
+        """
+        moved = self.crosshair.click(axis, x, y)
+        tracing.instant('planes.crosshair', plane=NAMES[axis],
+                        position=list(self.crosshair.position))
+        for other in moved:
+            slice_number = self.crosshair.slice_number(other)
+            if other == AXIAL:
+                # The slider redraws the axial plane.
+                self.ui.imageSliceSlider.setValue(slice_number)
+                self.prefetch_contours(slice_number)
+            else:
+                self.render_plane(other, slice_number)
+        self.update_crosshair()
 
     def setupCollectionTree(self):
         """
         Populate the collection/base image tree from the sqlite3 database.
+
+        Only the collections are added here.  The base images of a
+        collection are added when its branch is first expanded.
         """
         self.ui.collectionTreeWidget.setColumnCount(2)
         self.ui.collectionTreeWidget.setHeaderLabels(['Collection', 'Base Image'])
         QtCore.QObject.connect(self.ui.collectionTreeWidget,
                                QtCore.SIGNAL('itemClicked(QTreeWidgetItem*, int)'),
                                self.treeItemClicked)
-
-        conn = sqlite3.connect('moist_challenge.db')
-        c = conn.cursor()
+        QtCore.QObject.connect(self.ui.collectionTreeWidget,
+                               QtCore.SIGNAL('itemExpanded(QTreeWidgetItem*)'),
+                               self.populate_branch)
 
         # setup the top level items.  These are just the collection names.
-        sql = """
-              SELECT id, name from collection
-              """
-        c.execute(sql)
-        rows = c.fetchall()
-        for id, collection_name in rows:
-
-            branch = QtGui.QTreeWidgetItem(self.ui.collectionTreeWidget)
+        # The base images of all collections come from a single query, kept
+        # for populate_branch.
+        self.base_images = {}
+        branches = []
+        for collection_name, base_image_rows in self.repository.collection_tree():
+            self.base_images[collection_name] = base_image_rows
+
+            branch = QtGui.QTreeWidgetItem()
             branch.setText(0, collection_name)
-
-            # Get the base images for the collection.
-            sql = """
-                  SELECT base_image.id, base_image.file, base_image.label
-                  FROM base_image
-                  INNER JOIN collection
-                      ON base_image.collection_id = collection.id
-                  WHERE collection.name = ?
-                  """
-            print(sql)
-            c.execute(sql, (collection_name,))
-            base_image_rows = c.fetchall()
-            for base_image_id, base_image_relpath, label in base_image_rows:
-                leaf = QtGui.QTreeWidgetItem(branch)
-                leaf.setText(1, label)
-                leaf.setData(1, QtCore.Qt.UserRole, QtCore.QVariant(label))
-
-            branch.setExpanded(False)
-
+            if len(base_image_rows) > 0:
+                policy = QtGui.QTreeWidgetItem.ShowIndicator
+            else:
+                policy = QtGui.QTreeWidgetItem.DontShowIndicator
+            branch.setChildIndicatorPolicy(policy)
+            branches.append(branch)
+        self.ui.collectionTreeWidget.addTopLevelItems(branches)
+
+    def populate_branch(self, branch):
+        """
+        A collection was expanded.  Add its base images, unless that was
+        done before.
+        """
+        if branch.parent() is not None or branch.childCount() > 0:
+            return
+        leaves = []
+        for _, _, label in self.base_images.get(str(branch.text(0)), []):
+            leaf = QtGui.QTreeWidgetItem()
+            leaf.setText(1, label)
+            leaf.setData(1, QtCore.Qt.UserRole, QtCore.QVariant(label))
+            leaves.append(leaf)
+        branch.addChildren(leaves)
+
+    @tracing.traced('tree.click')
     def treeItemClicked(self, leaf, column):
         """
         A base image was chosen.  Retrieve the base image id from the widget
         and retrieve the runs associated with that image.
         """
+        self.cancel_execute()
+
         # Clear both combo boxes.
         self.ui.team1ComboBox.clear()
         self.ui.team2ComboBox.clear()
 
         label = leaf.data(column, QtCore.Qt.UserRole).toString()
-        print("Base image id = {0}".format(label))
+        tracing.instant('tree.select', label=str(label))
         self.label = label
-        print(type(label))
 
         # Get the runs associated with the base image and populate the combo
         # boxes.
-        conn = sqlite3.connect('moist_challenge.db')
-        cursor = conn.cursor()
-        sql = """
-              SELECT c.id, t.team, c.run_id
-              FROM challenge c INNER JOIN team t on t.id = c.team_id
-              WHERE label = ?
-              """
-        cursor.execute(sql, (str(label),))
-        print(sql, label)
-        rows = cursor.fetchall()
-        for challenge_id, team, run_id in rows:
+        rows = self.repository.runs_for_label(str(label))
+        for challenge_id, team, run_id, _ in rows:
             name = "{0}-{1}".format(team, run_id)
             userData = QtCore.QVariant(str(challenge_id))
             self.ui.team1ComboBox.addItem(name, userData=userData)
             self.ui.team2ComboBox.addItem(name, userData=userData)
 
+        if len(rows) > 1:
+            userData = QtCore.QVariant(CONSENSUS)
+            self.ui.team1ComboBox.addItem(CONSENSUS, userData=userData)
+            self.ui.team2ComboBox.addItem(CONSENSUS, userData=userData)
+
+        # Collection branches and the empty column of a leaf are not base
+        # images, and have no previews.
+        base_file = self.repository.base_image_file(str(label))
+        if base_file is None:
+            return
+        items = [(str(label), base_file)]
+        items.extend(("{0}-{1}".format(team, run_id), relfile)
+                     for _, team, run_id, relfile in rows)
+        self.show_previews(items)
+
+    @tracing.traced('render.previews')
+    def show_previews(self, items):
+        """
+        Show a grid of the precomputed previews of a base image and its runs,
+        without loading any volume.  Nothing is shown if make_db.py has not
+        rendered previews.
+
+        Parameters
+        ----------
+        items : list
+            (caption, relative file path) tuples.
+        """
+        # Small grids get the larger previews.
+        if len(items) <= 4:
+            size = preview.SIZES[-1]
+        else:
+            size = preview.SIZES[0]
+        pngs = self.repository.previews([relfile for _, relfile in items],
+                                        size)
+        if len(pngs) == 0:
+            return
+
+        # The grid replaces any slice view, so stop drawing into it.
+        self.clear_planes()
+        self.pixmap_item = None
+        self.scene = QtGui.QGraphicsScene(self)
+        self.ui.graphicsView.setScene(self.scene)
+
+        columns = int(math.ceil(math.sqrt(len(items))))
+        spacing = size // 8
+        for n, (caption, relfile) in enumerate(items):
+            if relfile not in pngs:
+                continue
+            pixmap = QtGui.QPixmap()
+            pixmap.loadFromData(pngs[relfile], 'PNG')
+            x = (n % columns) * (size + spacing)
+            y = (n // columns) * (size + 2 * spacing)
+            self.scene.addPixmap(pixmap).setPos(x, y)
+            text = self.scene.addSimpleText(caption)
+            text.setPos(x, y + pixmap.height())
+
+        self.ui.graphicsView.fitInView(self.scene.itemsBoundingRect(),
+                                       QtCore.Qt.KeepAspectRatio)
+
 if __name__ == "__main__":
-    app = QtGui.QApplication(sys.argv)
+    # Tracing may also be turned on with the CTSEG_TRACE environment
+    # variable, see the tracing module.  Other arguments are left to Qt.
+    parser = argparse.ArgumentParser(description='Moist challenge viewer')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write a Chrome trace of the session to FILE')
+    args, qt_args = parser.parse_known_args()
+    if args.trace is not None:
+        tracing.enable(args.trace)
+
+    app = QtGui.QApplication(sys.argv[:1] + qt_args)
     myapp = MyForm()
     myapp.show()
     sys.exit(app.exec_())
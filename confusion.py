@@ -0,0 +1,201 @@
+"""
+Multi-label and probabilistic scoring of a pair of segmentations.
+
+For label maps, the full label-by-label confusion matrix is computed in one
+pass, by counting combined label codes with bincount, which gives the
+overlap statistics of every label at once.
+
+For probabilistic maps, both maps are thresholded at each of a list of
+thresholds.  Rather than thresholding the volumes once per threshold, the
+number of voxels at or above every threshold is read off a cumulative
+histogram of each map and of their voxelwise minimum.
+"""
+import numpy as np
+
+from overlap import overlap_counts
+import roi
+
+# Default thresholds for probabilistic maps.
+THRESHOLDS = (0.1, 0.3, 0.5, 0.7, 0.9)
+
+# Label values below this are counted without remapping them first.
+MAX_DIRECT_LABEL = 256
+
+
+class ConfusionMatrix(object):
+    """
+    Voxel counts for each combination of labels in two label maps.
+
+    Attributes
+    ----------
+    labels : list
+        Label values, in increasing order.
+    counts : ndarray
+        counts[i, j] is the number of voxels with label labels[i] in the
+        first map and labels[j] in the second.  If the matrix was computed
+        within a region of interest, voxels outside it are not counted.
+    """
+    def __init__(self, labels, counts):
+        self.labels = [int(label) for label in labels]
+        self.counts = np.asarray(counts, dtype=np.int64)
+
+    def overlap(self, label, voxel_volume=1.0):
+        """
+        Overlap statistics of a single label.
+        """
+        if label not in self.labels:
+            return overlap_counts(0, 0, 0, voxel_volume=voxel_volume)
+        i = self.labels.index(label)
+        return overlap_counts(int(self.counts[i, :].sum()),
+                              int(self.counts[:, i].sum()),
+                              int(self.counts[i, i]),
+                              voxel_volume=voxel_volume)
+
+    def dice(self):
+        """
+        Dice coefficient of every foreground label, keyed by label.
+        """
+        return dict((label, self.overlap(label).dice)
+                    for label in self.labels if label != 0)
+
+    def swapped(self):
+        """
+        The matrix as if the two maps had been given in the opposite order.
+        """
+        return ConfusionMatrix(self.labels, self.counts.T)
+
+    def summary(self):
+        """
+        Short human-readable description, suitable for a label widget.
+        """
+        dice = self.dice()
+        items = ['{0}: {1}'.format(label, _fmt(dice[label]))
+                 for label in sorted(dice)]
+        return 'Dice by label:   ' + '  '.join(items)
+
+
+def _fmt(value):
+    if value is None:
+        return 'undefined'
+    return '{0:.4f}'.format(value)
+
+
+def confusion_matrix(image1, image2, box=None):
+    """
+    Compute the confusion matrix of two label maps.
+
+    Parameters
+    ----------
+    image1, image2 : ndarray
+        Integer label maps of identical shape.
+    box : tuple, optional
+        Region of interest containing every nonzero voxel of both images,
+        see the roi module.  Only voxels inside it are counted.
+
+    Returns
+    -------
+    ConfusionMatrix
+    """
+    if image1.shape != image2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(image1.shape, image2.shape))
+
+    index = roi.to_slices(box)
+    labels1 = np.asarray(image1[index], dtype=np.int64).ravel()
+    labels2 = np.asarray(image2[index], dtype=np.int64).ravel()
+    if len(labels1) == 0:
+        return ConfusionMatrix([], np.zeros((0, 0)))
+
+    low = min(labels1.min(), labels2.min())
+    high = max(labels1.max(), labels2.max())
+    if low >= 0 and high < MAX_DIRECT_LABEL:
+        # Small label values are used as codes directly.
+        n = int(high) + 1
+        labels = np.arange(n)
+        codes1, codes2 = labels1, labels2
+    else:
+        # Map the labels present onto 0, 1, ... first.
+        labels, codes = np.unique(np.concatenate((labels1, labels2)),
+                                  return_inverse=True)
+        n = len(labels)
+        codes1, codes2 = codes[:len(labels1)], codes[len(labels1):]
+    counts = np.bincount(codes1 * n + codes2,
+                         minlength=n * n).reshape(n, n)
+
+    # Keep only the labels that occur in either map.
+    present = np.flatnonzero(counts.sum(axis=0) + counts.sum(axis=1))
+    return ConfusionMatrix(labels[present], counts[np.ix_(present, present)])
+
+
+def is_probabilistic(image, box=None):
+    """
+    True if an image holds non-integer values, i.e. is a probability map
+    rather than a label map.
+    """
+    if not np.issubdtype(image.dtype, np.floating):
+        return False
+    data = image[roi.to_slices(box)]
+    return bool(np.any(data != np.round(data)))
+
+
+def _counts_at_or_above(values, thresholds):
+    """
+    Number of values at or above each threshold, from one histogram.
+    """
+    bins = np.searchsorted(thresholds, values.ravel(), side='right')
+    histogram = np.bincount(bins, minlength=len(thresholds) + 1)
+    return np.cumsum(histogram[::-1])[::-1][1:]
+
+
+def threshold_sweep(image1, image2, thresholds=THRESHOLDS, voxel_volume=1.0,
+                    box=None):
+    """
+    Overlap statistics of two probability maps thresholded at each of a
+    list of thresholds.  A voxel belongs to a thresholded map if its value
+    is at or above the threshold.  Label maps with values 0 and 1 may be
+    given too.
+
+    Parameters
+    ----------
+    image1, image2 : ndarray
+        Maps of identical shape.
+    thresholds : sequence
+        Thresholds to apply.
+    voxel_volume : float
+        Volume of a single voxel, used to scale the volume difference.
+    box : tuple, optional
+        Region of interest containing every nonzero voxel of both images.
+
+    Returns
+    -------
+    list
+        (threshold, OverlapResult) tuples in increasing threshold order.
+    """
+    if image1.shape != image2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(image1.shape, image2.shape))
+
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    index = roi.to_slices(box)
+    values1 = image1[index]
+    values2 = image2[index]
+
+    # A voxel is in both thresholded maps iff the smaller value is.
+    sizes1 = _counts_at_or_above(values1, thresholds)
+    sizes2 = _counts_at_or_above(values2, thresholds)
+    intersections = _counts_at_or_above(np.minimum(values1, values2),
+                                        thresholds)
+
+    return [(float(t), overlap_counts(int(size1), int(size2),
+                                      int(intersection),
+                                      voxel_volume=voxel_volume))
+            for t, size1, size2, intersection
+            in zip(thresholds, sizes1, sizes2, intersections)]
+
+
+def sweep_summary(sweep):
+    """
+    Short human-readable description of a threshold sweep.
+    """
+    items = ['{0:g}: {1}'.format(t, _fmt(result.dice)) for t, result in sweep]
+    return 'Dice by threshold:   ' + '  '.join(items)
@@ -0,0 +1,203 @@
+"""
+Consensus segmentations across all runs of a base image.
+
+The runs are streamed one at a time into a vote-count accumulator, so
+memory use does not grow with the number of runs.  The majority vote is
+written out as a NIfTI file next to a NIfTI file of the vote counts; the
+per-voxel agreement frequency is the vote count divided by the number of
+runs.
+"""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+from repository import get_repository
+from volume_cache import load_nifti
+
+# Label used for the consensus entry in the viewer.
+CONSENSUS = 'consensus'
+
+
+def consensus_id(base_image_id):
+    """
+    Stand-in challenge ID for the consensus of a base image.  Real challenge
+    IDs are positive, so these never collide with them.
+    """
+    return -base_image_id
+
+
+def accumulate_votes(paths, loader=load_nifti, label=1):
+    """
+    Count, for each voxel, how many of the segmentations contain it.
+
+    Parameters
+    ----------
+    paths : sequence
+        NIfTI files of the runs, which must all have the same shape.
+    loader : callable
+        Maps a path to a (data, zooms) tuple.
+    label : int
+        Label value counted as a vote.
+
+    Returns
+    -------
+    ndarray
+        Vote counts, uint8 unless there are more than 255 runs.
+    """
+    dtype = np.uint8 if len(paths) <= np.iinfo(np.uint8).max else np.uint16
+    votes = None
+    for path in paths:
+        data, _ = loader(path)
+        if votes is None:
+            votes = np.zeros(data.shape, dtype=dtype)
+        elif data.shape != votes.shape:
+            msg = "{0} has shape {1}, expected {2}."
+            raise ValueError(msg.format(path, data.shape, votes.shape))
+        np.add(votes, data == label, out=votes, casting='unsafe')
+    return votes
+
+
+class ConsensusBuilder(object):
+    """
+    Builds and caches the consensus of each base image.
+
+    Attributes
+    ----------
+    root : str
+        Root directory where Nifty files are expected to be found.
+    directory : str
+        Directory holding the consensus files, mirroring the layout under
+        root.
+    repository : Repository
+        Shared database connection.
+    loader : callable
+        Maps a path to a (data, zooms) tuple.
+    """
+    def __init__(self, root, repository, directory=None, loader=load_nifti):
+        self.root = root
+        if directory is None:
+            directory = os.path.join(root, '.consensus')
+        self.directory = directory
+        self.repository = repository
+        self.conn = repository.conn
+        self.cursor = self.conn.cursor()
+        self.loader = loader
+        self.create_consensus_table()
+
+    def create_consensus_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS consensus (
+                  base_image_id INTEGER PRIMARY KEY,
+                  file          TEXT,
+                  votes_file    TEXT,
+                  num_runs      INTEGER,
+                  fingerprint   TEXT,
+                  FOREIGN KEY(base_image_id) REFERENCES base_image(id)
+              )
+              """
+        with self.repository.lock:
+            self.cursor.execute(sql)
+            self.conn.commit()
+
+    def consensus_file(self, base_image_id):
+        """
+        Relative path of the majority-vote consensus of a base image.
+        """
+        return os.path.relpath(self._paths(base_image_id)[0], self.root)
+
+    def _paths(self, base_image_id):
+        with self.repository.lock:
+            self.cursor.execute('SELECT file FROM base_image WHERE id = ?',
+                                (base_image_id,))
+            relfile = self.cursor.fetchone()[0]
+        stem = os.path.join(self.directory, os.path.splitext(relfile)[0])
+        return stem + '_consensus.nii.gz', stem + '_votes.nii.gz'
+
+    def runs(self, base_image_id):
+        """
+        (relative path, mtime) of every run of a base image.
+        """
+        sql = """
+              SELECT file, mtime FROM challenge
+              WHERE base_image_id = ?
+              ORDER BY id
+              """
+        with self.repository.lock:
+            self.cursor.execute(sql, (base_image_id,))
+            return self.cursor.fetchall()
+
+    def update(self, base_image_id):
+        """
+        Build the consensus of a base image unless it is already current.
+
+        Returns
+        -------
+        str
+            Relative path of the majority-vote consensus.
+        """
+        runs = self.runs(base_image_id)
+        fingerprint = ';'.join('{0}:{1!r}'.format(f, m) for f, m in runs)
+        consensus_path, votes_path = self._paths(base_image_id)
+
+        sql = "SELECT fingerprint FROM consensus WHERE base_image_id = ?"
+        with self.repository.lock:
+            self.cursor.execute(sql, (base_image_id,))
+            row = self.cursor.fetchone()
+        if (row is not None and row[0] == fingerprint
+                and os.path.exists(consensus_path)):
+            return os.path.relpath(consensus_path, self.root)
+
+        if len(runs) == 0:
+            msg = "Base image {0} has no runs."
+            raise ValueError(msg.format(base_image_id))
+
+        paths = [os.path.join(self.root, relfile) for relfile, _ in runs]
+        votes = accumulate_votes(paths, loader=self.loader)
+        majority = (votes > len(runs) // 2).astype(np.uint8)
+
+        import nibabel as nib
+
+        dirname = os.path.dirname(consensus_path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        affine = nib.load(paths[0]).affine
+        nib.save(nib.Nifti1Image(majority, affine), consensus_path)
+        nib.save(nib.Nifti1Image(votes, affine), votes_path)
+
+        sql = """
+              INSERT OR REPLACE INTO consensus VALUES (?, ?, ?, ?, ?)
+              """
+        relfile = os.path.relpath(consensus_path, self.root)
+        with self.repository.lock:
+            self.cursor.execute(sql, (base_image_id, relfile,
+                                      os.path.relpath(votes_path, self.root),
+                                      len(runs), fingerprint))
+            self.conn.commit()
+        return relfile
+
+    def update_all(self):
+        with self.repository.lock:
+            self.cursor.execute('SELECT DISTINCT base_image_id FROM challenge')
+            base_image_ids = [row[0] for row in self.cursor.fetchall()]
+        # A base image whose runs differ in shape has no consensus, but
+        # does not stop the others.
+        for base_image_id in base_image_ids:
+            try:
+                print(self.update(base_image_id))
+            except ValueError as e:
+                msg = "Skipping base image {0}:  {1}\n"
+                sys.stderr.write(msg.format(base_image_id, e))
+
+
+if __name__ == '__main__':
+
+    description = 'Build consensus segmentations'
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('root', help='Data root')
+    parser.add_argument('--db', help='Database file')
+
+    args = parser.parse_args()
+    o = ConsensusBuilder(args.root, get_repository(args.db))
+    o.update_all()
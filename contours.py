@@ -0,0 +1,155 @@
+"""
+Per-slice segmentation contours, cached and prefetched in the background.
+
+Slices may be taken across any axis, see the planes module, and the
+contours of each plane are cached separately.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+from planes import AXIAL, in_plane_axes, plane_index
+import roi
+import tracing
+
+
+def _empty_points():
+    empty = np.zeros(0, dtype=np.int32)
+    return empty, empty
+
+
+def slice_contour_points(image_slice, level):
+    """
+    Pixel coordinates of all contours of a slice at the given level.
+
+    Returns
+    -------
+    rows, cols : ndarray
+        int32 arrays with the points of every contour concatenated, ready
+        to be used as a fancy index.
+    """
+    import skimage.measure
+
+    with tracing.span('contours.find', shape=image_slice.shape):
+        contours = skimage.measure.find_contours(image_slice, level)
+    if len(contours) == 0:
+        return _empty_points()
+    points = np.concatenate(contours).round().astype(np.int32)
+    return points[:, 0], points[:, 1]
+
+
+def outward_order(center, depth):
+    """
+    Slice numbers starting at center and alternating outwards.
+    """
+    order = [center]
+    for offset in range(1, depth):
+        for k in (center + offset, center - offset):
+            if 0 <= k < depth:
+                order.append(k)
+    return order
+
+
+class ContourCache(object):
+    """
+    Contour points keyed by (volume path, axis, slice number, level).
+
+    If the bounding box of a volume is known, slices outside it are empty
+    without looking at the data, and contours are extracted from the box
+    only.
+
+    Attributes
+    ----------
+    volumes : VolumeCache
+        Source of the segmentation volumes.
+    """
+    def __init__(self, volumes, threads=2):
+        self.volumes = volumes
+        self._contours = {}
+        self._boxes = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._pool = ThreadPool(threads)
+
+    def __contains__(self, key):
+        return key in self._contours
+
+    def set_box(self, path, box):
+        """
+        Record the bounding box of a volume, see the roi module.
+        """
+        self._boxes[path] = box
+
+    def discard(self, path):
+        """
+        Forget the contours of a volume, e.g. because its file was rewritten.
+        """
+        with self._lock:
+            for key in list(self._contours):
+                if key[0] == path:
+                    del self._contours[key]
+
+    def get(self, path, slice_number, level=0.8, axis=AXIAL):
+        """
+        Return the contour points of a slice across the given axis,
+        extracting them if needed.  Rows and columns run along the in-plane
+        axes of the slice.
+        """
+        key = (path, axis, slice_number, level)
+        try:
+            return self._contours[key]
+        except KeyError:
+            pass
+
+        box = self._boxes.get(path)
+        if not roi.contains_slice(box, slice_number, axis=axis):
+            points = _empty_points()
+        else:
+            data = self.volumes.get(path)
+            if box is None:
+                image_slice = data[plane_index(axis, slice_number)]
+                points = slice_contour_points(image_slice, level)
+            else:
+                # Keep a margin of background so that contours close.
+                padded = roi.pad(box, 1, data.shape)
+                index = list(roi.to_slices(padded))
+                index[axis] = slice_number
+                rows, cols = slice_contour_points(data[tuple(index)], level)
+                (i0, _), (j0, _) = [padded[a] for a in in_plane_axes(axis)]
+                points = rows + i0, cols + j0
+        with self._lock:
+            self._contours[key] = points
+        return points
+
+    def prefetch(self, paths, center, depth, level=0.8, axis=AXIAL):
+        """
+        Fill the cache in the background for every slice across the given
+        axis of the given volumes, starting at the center slice and moving
+        outwards.
+
+        Any prefetch already under way is abandoned, and contours of other
+        volumes are discarded.  Only slices within the bounding boxes of the
+        volumes are visited.
+        """
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            paths = list(paths)
+            for key in list(self._contours):
+                if key[0] not in paths:
+                    del self._contours[key]
+
+        boxes = [self._boxes.get(path) for path in paths]
+        tasks = [(generation, paths, k, level, axis)
+                 for k in outward_order(center, depth)
+                 if any(roi.contains_slice(box, k, axis=axis)
+                        for box in boxes)]
+        self._pool.map_async(self._fill, tasks, chunksize=1)
+
+    def _fill(self, task):
+        generation, paths, slice_number, level, axis = task
+        if generation != self._generation:
+            return
+        for path in paths:
+            self.get(path, slice_number, level, axis)
@@ -0,0 +1,75 @@
+"""
+Image geometry read from NIfTI headers alone.
+
+nibabel loads the voxel data lazily, so opening an image and asking for its
+shape, data type, spacing and affine reads only the header, even for
+gzipped files.
+"""
+import collections
+import json
+import os
+
+import numpy as np
+
+
+_FIELDS = ['shape', 'dtype', 'spacing', 'affine', 'file_size']
+
+
+class Geometry(collections.namedtuple('Geometry', _FIELDS)):
+    """
+    Attributes
+    ----------
+    shape : tuple
+        Array shape of the voxel data.
+    dtype : str
+        Data type of the voxel data on disk.
+    spacing : tuple
+        Voxel size along each axis.
+    affine : ndarray
+        4x4 voxel to world transform.
+    file_size : int
+        Size of the file in bytes.
+    """
+    __slots__ = ()
+
+    def matches(self, other, atol=1e-3):
+        """
+        True if voxels of the two images correspond one to one, i.e. the
+        shapes and affines agree.
+        """
+        return (self.shape[:3] == other.shape[:3]
+                and np.allclose(self.affine, other.affine, atol=atol))
+
+    def to_row(self):
+        """
+        Column values for the geometry table.
+        """
+        return (json.dumps(list(self.shape)), self.dtype,
+                json.dumps(list(self.spacing)),
+                json.dumps(self.affine.tolist()), self.file_size)
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Inverse of to_row.
+        """
+        shape, dtype, spacing, affine, file_size = row
+        return cls(shape=tuple(json.loads(shape)),
+                   dtype=dtype,
+                   spacing=tuple(json.loads(spacing)),
+                   affine=np.array(json.loads(affine)),
+                   file_size=file_size)
+
+
+def read_geometry(path):
+    """
+    Read the geometry of a NIfTI file without loading its voxel data.
+    """
+    import nibabel as nib
+
+    img = nib.load(path)
+    return Geometry(shape=tuple(int(x) for x in img.shape),
+                    dtype=str(img.get_data_dtype()),
+                    spacing=tuple(float(x) for x in img.header.get_zooms()),
+                    affine=np.asarray(img.affine, dtype=np.float64),
+                    file_size=os.path.getsize(path))
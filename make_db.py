@@ -1,60 +1,379 @@
 import argparse
-import glob
+import itertools
+import multiprocessing
 import os
-import sqlite3
+import re
+import sys
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from geometry import read_geometry
+import mask_archive
+import preview
+import roi
+from repository import get_repository
+from sidecar import SidecarStore
+import tracing
+from volume_cache import load_nifti
+
+# Team runs are named like alg01_run3.nii.gz, where 01 is the team ID.
+RUN_PATTERN = re.compile(r'^alg(?P<team_id>\d+)_run(?P<run_id>\d+)\.nii\.gz$')
+
+# Tables of results keyed by challenge or base image ID.
+ID_KEYED_TABLES = ('agreement', 'consensus', 'metric_cache',
+                   'segmentation_roi')
+
+
+def compute_roi(task):
+    """
+    Bounding box of a segmentation.  This is run in a worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        (challenge_id, path, mtime)
+
+    Returns
+    -------
+    tuple
+        (challenge_id, mtime, box)
+    """
+    challenge_id, path, mtime = task
+    data, _ = load_nifti(path)
+    return challenge_id, mtime, roi.bounding_box(data != 0)
+
 
 class CtSegDB(object):
-    def __init__(self, root):
+    def __init__(self, root, db=None):
         """
         Parameters
         ----------
         root : str
             Root directory where Nifty files are expected to be found.
+        db : str, optional
+            Database file, see repository.DEFAULT_PATH.
         """
-        self.conn = sqlite3.connect('moist_challenge.db')
+        self.repository = get_repository(db)
+        self.conn = self.repository.conn
         self.cursor = self.conn.cursor()
         self.root = root
 
     def __del__(self):
         self.conn.commit()
-        self.conn.close()
 
-    def run(self):
+    def run(self, rebuild=False):
+        """
+        Bring the database up to date with the files under the root.
+
+        Parameters
+        ----------
+        rebuild : bool
+            If true, drop and recreate all tables first.  Otherwise only the
+            rows for files that were added, removed or modified are touched,
+            so that row IDs and anything derived from them are preserved.
+        """
+        if rebuild:
+            # Row IDs start over, so tables keyed by them are dropped too.
+            # Their owners recreate them when next needed.
+            for table in ID_KEYED_TABLES + ('challenge', 'base_image', 'team',
+                                            'collection'):
+                self.cursor.execute('DROP TABLE IF EXISTS {0}'.format(table))
+
         self.create_collection_table()
         self.create_team_table()
         self.create_base_image_table()
         self.create_challenge_table()
+        self.repository.create_indexes()
 
         self.populate()
+        self.update_geometry()
+
+    @tracing.traced('index.sidecars')
+    def create_sidecars(self):
+        """
+        Convert every challenge run into an uncompressed, memory-mappable
+        sidecar file.
+        """
+        store = SidecarStore(self.root, repository=self.repository)
+        self.cursor.execute('SELECT file FROM challenge')
+        for relfile, in self.cursor.fetchall():
+            path = os.path.join(self.root, relfile)
+            store.convert(path)
+
+    @tracing.traced('index.archives')
+    def create_archives(self, processes=None):
+        """
+        Write the bit-packed container of every collection whose runs were
+        added, removed or modified since it was last written.
+        """
+        archive = mask_archive.MaskArchive(self.root)
+        if not os.path.isdir(archive.directory):
+            os.makedirs(archive.directory)
 
-    def create_team_table(self):
         sql = """
-              DROP TABLE IF EXISTS team
+              SELECT collection.name, c.file, c.mtime
+              FROM challenge c
+              INNER JOIN collection ON collection.id = c.collection_id
+              ORDER BY collection.name, c.file
               """
         self.cursor.execute(sql)
+        rows = self.cursor.fetchall()
 
+        num_written = 0
+        pool = multiprocessing.Pool(processes)
+        try:
+            for collection, group in itertools.groupby(rows,
+                                                       lambda row: row[0]):
+                runs = [(relfile, mtime,
+                         os.path.getsize(os.path.join(self.root, relfile)))
+                        for _, relfile, mtime in group]
+                path = archive.container_path(collection)
+                index = mask_archive.read_index(path)
+                if (len(index) == len(runs)
+                        and all(relfile in index
+                                and mask_archive.is_current(index[relfile],
+                                                            mtime, size)
+                                for relfile, mtime, size in runs)):
+                    continue
+                paths = [os.path.join(self.root, relfile)
+                         for relfile, _, _ in runs]
+                packed = pool.imap(mask_archive.pack_run, paths)
+                mask_archive.write_container(
+                    path, (run + (p,) for run, p in zip(runs, packed)))
+                num_written += 1
+        finally:
+            pool.close()
+            pool.join()
+        print("archives:  {0} collections written".format(num_written))
+
+    def create_roi_table(self):
         sql = """
-              CREATE TABLE team (
-                  id            INTEGER PRIMARY KEY AUTOINCREMENT,
-                  team          VARCHAR(30)
+              CREATE TABLE IF NOT EXISTS segmentation_roi (
+                  challenge_id  INTEGER PRIMARY KEY,
+                  mtime         REAL,
+                  empty         INTEGER,
+                  istart        INTEGER,
+                  istop         INTEGER,
+                  jstart        INTEGER,
+                  jstop         INTEGER,
+                  kstart        INTEGER,
+                  kstop         INTEGER,
+                  FOREIGN KEY(challenge_id) REFERENCES challenge(id)
               )
               """
         self.cursor.execute(sql)
+        self.conn.commit()
+
+    @tracing.traced('index.rois')
+    def compute_rois(self, processes=None):
+        """
+        Store the bounding box and nonempty slice range of every challenge
+        run whose box is missing or older than the run file.
+        """
+        self.create_roi_table()
+
+        sql = """
+              DELETE FROM segmentation_roi
+              WHERE challenge_id NOT IN (SELECT id FROM challenge)
+              """
+        self.cursor.execute(sql)
+
+        sql = """
+              SELECT c.id, c.file, c.mtime
+              FROM challenge c
+              LEFT JOIN segmentation_roi r ON r.challenge_id = c.id
+              WHERE r.mtime IS NULL OR r.mtime != c.mtime
+              """
+        self.cursor.execute(sql)
+        tasks = [(challenge_id, os.path.join(self.root, relfile), mtime)
+                 for challenge_id, relfile, mtime in self.cursor.fetchall()]
+
+        rows = []
+        pool = multiprocessing.Pool(processes)
+        try:
+            for challenge_id, mtime, box in pool.imap_unordered(compute_roi,
+                                                                tasks):
+                if box == roi.EMPTY:
+                    rows.append((challenge_id, mtime, 1) + (None,) * 6)
+                else:
+                    coords = tuple(x for axis in box for x in axis)
+                    rows.append((challenge_id, mtime, 0) + coords)
+        finally:
+            pool.close()
+            pool.join()
+
+        sql = """
+              INSERT OR REPLACE INTO segmentation_roi VALUES
+              (?, ?, ?, ?, ?, ?, ?, ?, ?)
+              """
+        self.cursor.executemany(sql, rows)
+        self.conn.commit()
+        print("bounding boxes:  {0} computed".format(len(rows)))
 
-        self.cursor.execute("INSERT INTO team VALUES (NULL, 'cumc')")
-        self.cursor.execute("INSERT INTO team VALUES (NULL, 'moffitt')")
-        self.cursor.execute("INSERT INTO team VALUES (NULL, 'stanford')")
-        
+    def create_geometry_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS geometry (
+                  file          TEXT PRIMARY KEY,
+                  mtime         REAL,
+                  shape         TEXT,
+                  dtype         TEXT,
+                  spacing       TEXT,
+                  affine        TEXT,
+                  file_size     INTEGER
+              )
+              """
+        self.cursor.execute(sql)
         self.conn.commit()
 
-    def create_challenge_table(self):
+    @tracing.traced('index.geometry')
+    def update_geometry(self):
+        """
+        Read the header of every base image and challenge run whose geometry
+        is missing or older than the file.  No voxel data is read.
+        """
+        self.create_geometry_table()
+
+        sql = """
+              SELECT f.file, f.mtime
+              FROM (SELECT file, mtime FROM base_image
+                    UNION ALL
+                    SELECT file, mtime FROM challenge) f
+              LEFT JOIN geometry g ON g.file = f.file
+              WHERE g.mtime IS NULL OR g.mtime != f.mtime
+              """
+        self.cursor.execute(sql)
+        files = self.cursor.fetchall()
+
+        def read(item):
+            relfile, mtime = item
+            geometry = read_geometry(os.path.join(self.root, relfile))
+            return (relfile, mtime) + geometry.to_row()
+
+        pool = ThreadPool(8)
+        try:
+            rows = pool.map(read, files)
+        finally:
+            pool.close()
+            pool.join()
+
         sql = """
-              DROP TABLE IF EXISTS challenge
+              INSERT OR REPLACE INTO geometry VALUES (?, ?, ?, ?, ?, ?, ?)
+              """
+        self.cursor.executemany(sql, rows)
+        sql = """
+              DELETE FROM geometry
+              WHERE file NOT IN (SELECT file FROM base_image
+                                 UNION ALL
+                                 SELECT file FROM challenge)
               """
         self.cursor.execute(sql)
+        self.conn.commit()
+        print("geometry:  {0} headers read".format(len(rows)))
 
+    def create_preview_table(self):
         sql = """
-              CREATE TABLE challenge (
+              CREATE TABLE IF NOT EXISTS preview (
+                  file          TEXT,
+                  size          INTEGER,
+                  mtime         REAL,
+                  slice_number  INTEGER,
+                  png           BLOB,
+                  PRIMARY KEY(file, size)
+              )
+              """
+        self.cursor.execute(sql)
+        self.conn.commit()
+
+    @tracing.traced('index.previews')
+    def create_previews(self, processes=None):
+        """
+        Render key-slice previews of every base image whose previews, or
+        those of any of its runs, are missing or older than the files.
+        """
+        self.create_preview_table()
+
+        sql = """
+              DELETE FROM preview
+              WHERE file NOT IN (SELECT file FROM base_image
+                                 UNION ALL
+                                 SELECT file FROM challenge)
+              """
+        self.cursor.execute(sql)
+
+        # Previews of all sizes are written together, so checking one size
+        # is enough.
+        sql = """
+              SELECT b.id, b.file, b.mtime, c.file, c.mtime,
+                     pb.mtime = b.mtime AND
+                     (c.id IS NULL OR pc.mtime = c.mtime)
+              FROM base_image b
+              LEFT JOIN challenge c ON c.base_image_id = b.id
+              LEFT JOIN preview pb ON pb.file = b.file AND pb.size = ?
+              LEFT JOIN preview pc ON pc.file = c.file AND pc.size = ?
+              ORDER BY b.id, c.id
+              """
+        size = preview.SIZES[0]
+        self.cursor.execute(sql, (size, size))
+        tasks = []
+        for _, group in itertools.groupby(self.cursor.fetchall(),
+                                          lambda row: row[0]):
+            group = list(group)
+            if all(row[5] for row in group):
+                continue
+            runs = [(row[3], row[4]) for row in group if row[3] is not None]
+            tasks.append((self.root, (group[0][1], group[0][2]), runs,
+                          preview.SIZES))
+
+        sql = """
+              INSERT OR REPLACE INTO preview VALUES (?, ?, ?, ?, ?)
+              """
+        pool = multiprocessing.Pool(processes)
+        try:
+            for rows, skipped in pool.imap_unordered(preview.render_previews,
+                                                     tasks):
+                self.cursor.executemany(sql, rows)
+                msg = "Drawing preview of {0} without its contour:  {1}\n"
+                for relfile, reason in skipped:
+                    sys.stderr.write(msg.format(relfile, reason))
+        finally:
+            pool.close()
+            pool.join()
+        self.conn.commit()
+        print("previews:  {0} base images rendered".format(len(tasks)))
+
+    def add_column(self, table, column, declaration):
+        """
+        Add a column to a table created by an older version of this script.
+        """
+        self.cursor.execute('PRAGMA table_info({0})'.format(table))
+        if column not in [row[1] for row in self.cursor.fetchall()]:
+            sql = 'ALTER TABLE {0} ADD COLUMN {1} {2}'
+            self.cursor.execute(sql.format(table, column, declaration))
+
+    def create_team_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS team (
+                  id            INTEGER PRIMARY KEY AUTOINCREMENT,
+                  team          VARCHAR(30)
+              )
+              """
+        self.cursor.execute(sql)
+
+        self.cursor.execute('SELECT COUNT(*) FROM team')
+        if self.cursor.fetchone()[0] == 0:
+            self.cursor.execute("INSERT INTO team VALUES (NULL, 'cumc')")
+            self.cursor.execute("INSERT INTO team VALUES (NULL, 'moffitt')")
+            self.cursor.execute("INSERT INTO team VALUES (NULL, 'stanford')")
+
+        self.conn.commit()
+
+    def create_challenge_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS challenge (
                   id            INTEGER PRIMARY KEY AUTOINCREMENT,
                   base_image_id INTEGER,
                   team_id       INTEGER,
@@ -62,130 +381,215 @@ class CtSegDB(object):
                   label         TEXT,
                   run_id        INTEGER,
                   file          TEXT,
+                  mtime         REAL,
                   FOREIGN KEY(base_image_id) REFERENCES base_image(id),
                   FOREIGN KEY(team_id) REFERENCES team(id),
                   FOREIGN KEY(collection_id) REFERENCES collection(id)
               )
               """
         self.cursor.execute(sql)
+        self.add_column('challenge', 'mtime', 'REAL')
         self.conn.commit()
-        
 
-    def create_base_image_table(self):
-        sql = """
-              DROP TABLE IF EXISTS base_image
-              """
-        self.cursor.execute(sql)
 
+    def create_base_image_table(self):
         sql = """
-              CREATE TABLE base_image (
+              CREATE TABLE IF NOT EXISTS base_image (
                   id            INTEGER PRIMARY KEY AUTOINCREMENT,
                   collection_id INTEGER,
                   label         TEXT,
                   file          TEXT,
+                  mtime         REAL,
                   FOREIGN KEY(collection_id) REFERENCES collection(id)
               )
               """
         self.cursor.execute(sql)
-        
+        self.add_column('base_image', 'mtime', 'REAL')
+
+    @tracing.traced('index.scan')
+    def scan_collection(self, collection, team_ids):
+        """
+        Find the base images and team runs of a collection on disk.
+
+        This does not touch the database, so collections can be scanned in
+        parallel.
+
+        Returns
+        -------
+        dict
+            Maps the relative path of each base image to a tuple of its
+            label, mtime and runs.  The runs are a dict mapping the relative
+            path of each run to a tuple of team ID, run ID and mtime.
+        """
+        # Two items in the next directory level.  There may be nifty files,
+        # soft-links, or directories.  The names of the directories are the
+        # labels.  Corresponding to each label should be a nifty file
+        # with the same name.  This may be a soft link or an actual file.
+        base_images = {}
+        for entry in scandir(os.path.join(self.root, collection)):
+            if not entry.is_dir():
+                continue
+            label = entry.name
+            nifti = entry.path + '.nii'
+            if not os.path.exists(nifti):
+                msg = "Expected NIFTI {} did not exist"
+                raise RuntimeError(msg.format(nifti))
+
+            runs = {}
+            for run_entry in scandir(entry.path):
+                match = RUN_PATTERN.match(run_entry.name)
+                if match is None:
+                    continue
+                team_id = int(match.group('team_id'))
+                if team_id not in team_ids:
+                    continue
+                relfile = os.path.join(collection, label, run_entry.name)
+                runs[relfile] = (team_id, int(match.group('run_id')),
+                                 run_entry.stat().st_mtime)
+
+            # Just store the path relative to the root.
+            relfile = os.path.join(collection, label + '.nii')
+            base_images[relfile] = (label, os.stat(nifti).st_mtime, runs)
+
+        return base_images
+
+    @tracing.traced('index.populate')
     def populate(self):
-        collection_dirs = glob.glob(os.path.join(self.root, '*'))
-
-        # Verify that the directory names are valid.
-        sql1 = """
-               SELECT id FROM collection
-               WHERE name = ?
-               """
-        for collection in [os.path.basename(d) for d in collection_dirs]:
-            self.cursor.execute(sql1, (collection,))
-            results = self.cursor.fetchall()
-
-            # The only directory entries here should be collection names.
-            assert(len(results) == 1)
-
-            collection_id = results[0][0]
-
-            # Two items in the next directory level.  There may be nifty files,
-            # soft-links, or directories.  The names of the directories are the
-            # labels.  Corresponding to each label should be a nifty file 
-            # with the same name.  This may be a soft link or an actual file.
-            items = glob.glob(os.path.join(self.root, collection, '*'))
-            labels = [os.path.basename(item) for item in items if
-                      os.path.isdir(item)]
-            for label in labels:
-                label_dir = os.path.join(self.root, collection, label)
-                nifti = label_dir + '.nii'
-                if not os.path.exists(nifti):
-                    msg = "Expected NIFTI {} did not exist"
-                    raise RuntimeError(msg.format(nifti))
-
-                # Just store the path relative to the root.
-                relfile = nifti[len(self.root) + 1:]
-                sql2 = """
-                       INSERT INTO base_image VALUES (NULL, ?, ?, ?)
-                       """
-                self.cursor.execute(sql2, (collection_id, label, relfile))
-
-                # Get the base image ID back
-                sql3 = """
-                       SELECT id from base_image
-                       WHERE file = ?
-                       """
-                self.cursor.execute(sql3, (relfile,))
-                base_image_id = self.cursor.fetchone()[0]
-
-                self.cursor.execute('SELECT * from team ORDER BY id')
-                for team_id, team in self.cursor.fetchall():
-                    path = os.path.join(self.root, collection, label,
-                                        'alg{:02}_run*.nii.gz'.format(team_id))
-                    lst = glob.glob(path)
-
-                    for item in lst:
-
-                        # Get the run ID.  This is brittle, should be
-                        # replaced.
-                        run_id = int(item[-8])
-
-                        relfile = item[len(self.root) + 1:]
-                        sql4 = """
-                               INSERT INTO challenge VALUES
-                               (NULL, ?, ?, ?, ?, ?, ?)
-                               """
-                        self.cursor.execute(sql4, (base_image_id, team_id,
-                                                   collection_id, label,
-                                                   run_id, relfile)) 
+        """
+        Index the base images and team runs under the root incrementally.
+        """
+        self.cursor.execute('SELECT name, id FROM collection')
+        collection_ids = dict(self.cursor.fetchall())
+        self.cursor.execute('SELECT id FROM team')
+        team_ids = set(row[0] for row in self.cursor.fetchall())
 
+        # The only directory entries here should be collection names.
+        collections = [entry.name for entry in scandir(self.root)
+                       if not entry.name.startswith('.')]
+        for collection in collections:
+            assert(collection in collection_ids)
 
-        self.conn.commit()
+        pool = ThreadPool(max(len(collections), 1))
+        try:
+            scans = pool.map(lambda c: self.scan_collection(c, team_ids),
+                             collections)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.cursor.execute('SELECT file, id, mtime FROM base_image')
+        old_base_images = dict((f, (i, m)) for f, i, m in self.cursor.fetchall())
+        self.cursor.execute('SELECT file, id, mtime FROM challenge')
+        old_runs = dict((f, (i, m)) for f, i, m in self.cursor.fetchall())
+
+        num_added = 0
+        new_runs = []
+        changed = []
+        changed_runs = []
+        seen_runs = set()
+        for collection, base_images in zip(collections, scans):
+            collection_id = collection_ids[collection]
+            for relfile, (label, mtime, runs) in base_images.items():
+                if relfile in old_base_images:
+                    base_image_id, old_mtime = old_base_images.pop(relfile)
+                    if mtime != old_mtime:
+                        changed.append((mtime, base_image_id))
+                else:
+                    sql = """
+                          INSERT INTO base_image VALUES (NULL, ?, ?, ?, ?)
+                          """
+                    self.cursor.execute(sql, (collection_id, label, relfile,
+                                              mtime))
+                    base_image_id = self.cursor.lastrowid
+                    num_added += 1
+
+                for run_relfile, (team_id, run_id, run_mtime) in runs.items():
+                    seen_runs.add(run_relfile)
+                    if run_relfile in old_runs:
+                        challenge_id, old_mtime = old_runs[run_relfile]
+                        if run_mtime != old_mtime:
+                            changed_runs.append((run_mtime, challenge_id))
+                    else:
+                        new_runs.append((base_image_id, team_id,
+                                         collection_id, label, run_id,
+                                         run_relfile, run_mtime))
+
+        removed_runs = [(challenge_id,)
+                        for relfile, (challenge_id, _) in old_runs.items()
+                        if relfile not in seen_runs]
+        removed = [(base_image_id,)
+                   for base_image_id, _ in old_base_images.values()]
 
-    def create_collection_table(self):
         sql = """
-              DROP TABLE IF EXISTS collection
+              INSERT INTO challenge VALUES (NULL, ?, ?, ?, ?, ?, ?, ?)
               """
-        self.cursor.execute(sql)
-        
+        self.cursor.executemany(sql, new_runs)
+        sql = "UPDATE challenge SET mtime = ? WHERE id = ?"
+        self.cursor.executemany(sql, changed_runs)
+        sql = "DELETE FROM challenge WHERE id = ?"
+        self.cursor.executemany(sql, removed_runs)
+
+        sql = "UPDATE base_image SET mtime = ? WHERE id = ?"
+        self.cursor.executemany(sql, changed)
+        sql = "DELETE FROM base_image WHERE id = ?"
+        self.cursor.executemany(sql, removed)
+
+        self.conn.commit()
+
+        msg = ("challenge runs:  {0} added, {1} modified, {2} removed\n"
+               "base images:  {3} added, {4} modified, {5} removed")
+        print(msg.format(len(new_runs), len(changed_runs), len(removed_runs),
+                         num_added, len(changed), len(removed)))
+
+    def create_collection_table(self):
         sql = """
-              CREATE TABLE collection (
+              CREATE TABLE IF NOT EXISTS collection (
                   id   INTEGER PRIMARY KEY AUTOINCREMENT,
                   name VARCHAR(30)
               )
               """
         self.cursor.execute(sql)
-        
-        self.cursor.execute("INSERT INTO collection VALUES (NULL, 'cumc')")
-        self.cursor.execute("INSERT INTO collection VALUES (NULL, 'lidc')")
-        self.cursor.execute("INSERT INTO collection VALUES (NULL, 'moffitt')")
-        self.cursor.execute("INSERT INTO collection VALUES (NULL, 'rider')")
-        self.cursor.execute("INSERT INTO collection VALUES (NULL, 'stanford')")
+
+        self.cursor.execute('SELECT COUNT(*) FROM collection')
+        if self.cursor.fetchone()[0] == 0:
+            self.cursor.execute("INSERT INTO collection VALUES (NULL, 'cumc')")
+            self.cursor.execute("INSERT INTO collection VALUES (NULL, 'lidc')")
+            self.cursor.execute("INSERT INTO collection VALUES (NULL, 'moffitt')")
+            self.cursor.execute("INSERT INTO collection VALUES (NULL, 'rider')")
+            self.cursor.execute("INSERT INTO collection VALUES (NULL, 'stanford')")
 
         self.conn.commit()
-        
+
 if __name__ == '__main__':
-    
+
     description='Create moist challenge database'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('root', help='Data root')
+    parser.add_argument('--db', help='Database file')
+    parser.add_argument('--rebuild', action='store_true',
+                        help='Drop and recreate all tables instead of '
+                             'updating them incrementally')
+    parser.add_argument('--sidecar', action='store_true',
+                        help='Also write memory-mappable sidecar files')
+    parser.add_argument('--roi', action='store_true',
+                        help='Also compute segmentation bounding boxes')
+    parser.add_argument('--previews', action='store_true',
+                        help='Also render key-slice previews')
+    parser.add_argument('--archive', action='store_true',
+                        help='Also write bit-packed run archives')
+    parser.add_argument('--trace', metavar='FILE',
+                        help='Write a Chrome trace of the run to FILE')
 
     args = parser.parse_args()
-    o = CtSegDB(args.root)
-    o.run()
+    if args.trace is not None:
+        tracing.enable(args.trace)
+    o = CtSegDB(args.root, db=args.db)
+    o.run(rebuild=args.rebuild)
+    if args.sidecar:
+        o.create_sidecars()
+    if args.roi:
+        o.compute_rois()
+    if args.previews:
+        o.create_previews()
+    if args.archive:
+        o.create_archives()
@@ -0,0 +1,247 @@
+"""
+Bit-packed archive of the binary challenge runs.
+
+Each run is stored as one bit per voxel, cropped to the range of slices
+that contain the segmentation.  Every slice is packed separately and padded
+to a whole byte, so the packed slices of two runs of the same base image
+line up and can be compared with bitwise AND and a population count,
+without unpacking.
+
+The runs of a collection share one container file,
+<root>/.archive/<collection>.bits, laid out as
+
+    8 byte magic, 8 byte little-endian offset of the index
+    packed runs, one after the other
+    JSON index mapping each run's relative path to its record
+
+Containers are written by make_db.py --archive and are read through
+memory maps.  Each record keeps the mtime and size of the run file it was
+packed from, so that a stale record can be told apart from a current one.
+"""
+import json
+import os
+import struct
+
+import numpy as np
+
+from overlap import overlap_counts
+from volume_cache import load_nifti
+
+MAGIC = b'CTSEGBIT'
+_HEADER = struct.Struct('<8sQ')
+
+# Number of set bits in each possible byte.
+_POPCOUNT = np.array([bin(n).count('1') for n in range(256)], dtype=np.uint8)
+
+
+def popcount(bits):
+    """
+    Number of set bits in a uint8 array.
+    """
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(bits).sum(dtype=np.int64))
+    return int(_POPCOUNT[bits].sum(dtype=np.int64))
+
+
+class PackedMask(object):
+    """
+    A binary mask stored as one bit per voxel.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the unpacked mask.
+    kstart, kstop : int
+        Range of slices holding the packed bits.  Slices outside it are
+        empty.
+    bits : ndarray
+        uint8 array of shape (kstop - kstart, bytes per slice).
+    count : int
+        Number of voxels in the mask.
+    zooms : tuple
+        Voxel spacing.
+    """
+    def __init__(self, shape, kstart, kstop, bits, count, zooms):
+        self.shape = tuple(shape)
+        self.kstart = kstart
+        self.kstop = kstop
+        self.bits = bits
+        self.count = count
+        self.zooms = tuple(zooms)
+
+    @classmethod
+    def pack(cls, mask, zooms=(1.0, 1.0, 1.0)):
+        """
+        Pack a boolean mask.
+        """
+        slices = np.flatnonzero(np.any(mask, axis=(0, 1)))
+        if len(slices) == 0:
+            kstart = kstop = 0
+        else:
+            kstart, kstop = int(slices[0]), int(slices[-1]) + 1
+        slab = mask[:, :, kstart:kstop].transpose(2, 0, 1)
+        nvoxels = mask.shape[0] * mask.shape[1]
+        bits = np.packbits(slab.reshape(kstop - kstart, nvoxels), axis=1)
+        return cls(mask.shape, kstart, kstop, bits, popcount(bits), zooms)
+
+    def unpack(self):
+        """
+        The boolean mask.
+        """
+        mask = np.zeros(self.shape, dtype=np.bool_)
+        nk = self.kstop - self.kstart
+        nvoxels = self.shape[0] * self.shape[1]
+        slab = np.unpackbits(self.bits, axis=1)[:, :nvoxels].astype(np.bool_)
+        mask[:, :, self.kstart:self.kstop] = slab.reshape(
+            (nk,) + self.shape[:2]).transpose(1, 2, 0)
+        return mask
+
+    def intersection(self, other):
+        """
+        Number of voxels in both masks, counted on the packed bits.
+        """
+        if self.shape != other.shape:
+            msg = "Image shapes {0} and {1} do not match."
+            raise ValueError(msg.format(self.shape, other.shape))
+        kstart = max(self.kstart, other.kstart)
+        kstop = min(self.kstop, other.kstop)
+        if kstop <= kstart:
+            return 0
+        bits1 = self.bits[kstart - self.kstart:kstop - self.kstart]
+        bits2 = other.bits[kstart - other.kstart:kstop - other.kstart]
+        return popcount(np.bitwise_and(bits1, bits2))
+
+
+def overlap_packed(mask1, mask2, voxel_volume=1.0):
+    """
+    Compute overlap statistics between two packed masks.
+
+    See Also
+    --------
+    overlap.overlap_masks
+    """
+    return overlap_counts(mask1.count, mask2.count,
+                          mask1.intersection(mask2),
+                          voxel_volume=voxel_volume)
+
+
+def write_container(path, items):
+    """
+    Write a container file, replacing any previous one atomically.
+
+    Parameters
+    ----------
+    path : str
+        Container file.
+    items : iterable
+        (relative path, mtime, file size, PackedMask) tuples.
+    """
+    index = {}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, 0))
+        for relfile, mtime, size, packed in items:
+            index[relfile] = {'offset': f.tell(),
+                              'mtime': mtime,
+                              'size': size,
+                              'shape': list(packed.shape),
+                              'kstart': packed.kstart,
+                              'kstop': packed.kstop,
+                              'row_bytes': packed.bits.shape[1],
+                              'count': packed.count,
+                              'zooms': [float(x) for x in packed.zooms]}
+            f.write(np.ascontiguousarray(packed.bits).tobytes())
+        index_offset = f.tell()
+        f.write(json.dumps(index).encode('utf-8'))
+        f.seek(0)
+        f.write(_HEADER.pack(MAGIC, index_offset))
+    os.rename(tmp, path)
+
+
+def is_current(record, mtime, size):
+    """
+    True if an index record was packed from a run file with the given mtime
+    and size.
+    """
+    return record.get('mtime') == mtime and record.get('size') == size
+
+
+def read_index(path):
+    """
+    The index of a container file, or an empty dict if it does not exist.
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rb') as f:
+        magic, index_offset = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != MAGIC:
+            raise IOError("{0} is not a mask archive.".format(path))
+        f.seek(index_offset)
+        return json.loads(f.read().decode('utf-8'))
+
+
+def pack_run(path):
+    """
+    Pack the label 1 voxels of a challenge run.  This is run in a worker
+    process.
+    """
+    data, zooms = load_nifti(path)
+    return PackedMask.pack(data == 1, zooms[:3])
+
+
+class MaskArchive(object):
+    """
+    Reads packed runs from the container files under a data root.
+
+    Attributes
+    ----------
+    root : str
+        Root directory where Nifty files are expected to be found.
+    directory : str
+        Directory holding the container files.
+    """
+    def __init__(self, root, directory=None):
+        self.root = root
+        if directory is None:
+            directory = os.path.join(root, '.archive')
+        self.directory = directory
+        self._containers = {}
+
+    def container_path(self, collection):
+        return os.path.join(self.directory, collection + '.bits')
+
+    def _container(self, collection):
+        if collection not in self._containers:
+            path = self.container_path(collection)
+            data = np.memmap(path, dtype=np.uint8, mode='r')
+            self._containers[collection] = (data, read_index(path))
+        return self._containers[collection]
+
+    def is_current(self, relfile):
+        """
+        True if the archive holds the run, given its path relative to the
+        root, packed from the file as it is now.
+        """
+        collection = relfile.split(os.sep)[0]
+        if not os.path.exists(self.container_path(collection)):
+            return False
+        _, index = self._container(collection)
+        if relfile not in index:
+            return False
+        st = os.stat(os.path.join(self.root, relfile))
+        return is_current(index[relfile], st.st_mtime, st.st_size)
+
+    def get(self, relfile):
+        """
+        The PackedMask of a run, given its path relative to the root.  Use
+        is_current first, the record may be missing or stale.
+        """
+        collection = relfile.split(os.sep)[0]
+        data, index = self._container(collection)
+        record = index[relfile]
+        nk = record['kstop'] - record['kstart']
+        start = record['offset']
+        stop = start + nk * record['row_bytes']
+        bits = data[start:stop].reshape(nk, record['row_bytes'])
+        return PackedMask(record['shape'], record['kstart'], record['kstop'],
+                          bits, record['count'], record['zooms'])
@@ -0,0 +1,244 @@
+"""
+Persistent cache of pairwise metrics in the moist challenge database.
+"""
+import os
+import re
+
+from confusion import ConfusionMatrix
+from overlap import OverlapResult
+from surface_distance import SurfaceDistanceResult
+
+
+_CONFUSION = re.compile(r'^confusion\[(-?\d+),(-?\d+)\]$')
+_SWEEP = re.compile(r'^sweep\[([^\]]+)\]\.(\w+)$')
+
+
+class MetricCache(object):
+    """
+    Metric values keyed by challenge pair, metric name and file fingerprint.
+
+    Pairs are stored in canonical order (lower challenge id first), so that
+    (A, B) and (B, A) share the same entries.  The fingerprint is built from
+    the size and modification time of both run files; when either file
+    changes on disk, the cached values no longer match and are replaced the
+    next time the pair is scored.
+
+    Attributes
+    ----------
+    repository : Repository
+        Database holding the cache.
+    conn, cursor : database connection objects
+    root : str
+        Root directory where Nifty files are expected to be found.
+    """
+    def __init__(self, repository, root):
+        self.repository = repository
+        self.conn = repository.conn
+        self.cursor = self.conn.cursor()
+        self.root = root
+        self.create_metric_cache_table()
+
+    def create_metric_cache_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS metric_cache (
+                  challenge_id1 INTEGER,
+                  challenge_id2 INTEGER,
+                  metric        TEXT,
+                  fingerprint   TEXT,
+                  value         REAL,
+                  PRIMARY KEY(challenge_id1, challenge_id2, metric),
+                  FOREIGN KEY(challenge_id1) REFERENCES challenge(id),
+                  FOREIGN KEY(challenge_id2) REFERENCES challenge(id)
+              )
+              """
+        with self.repository.lock:
+            self.cursor.execute(sql)
+            self.conn.commit()
+
+    def fingerprint(self, relfile):
+        """
+        Identify the current state of a run file by its size and mtime.
+        """
+        st = os.stat(os.path.join(self.root, relfile))
+        return '{0}:{1!r}'.format(st.st_size, st.st_mtime)
+
+    def _key(self, challenge_id1, file1, challenge_id2, file2):
+        """
+        Canonical (id1, id2, fingerprint, swapped) for a pair.
+        """
+        swapped = challenge_id1 > challenge_id2
+        if swapped:
+            challenge_id1, challenge_id2 = challenge_id2, challenge_id1
+            file1, file2 = file2, file1
+        fingerprint = self.fingerprint(file1) + '|' + self.fingerprint(file2)
+        return challenge_id1, challenge_id2, fingerprint, swapped
+
+    def get(self, challenge_id1, file1, challenge_id2, file2, metrics=None):
+        """
+        Retrieve cached metric values for a pair.
+
+        Values are returned as stored for the canonical pair order; callers
+        with order-dependent metrics should use the swapped flag.  If
+        metrics is None, every cached metric of the pair is returned.
+
+        Returns
+        -------
+        values : dict
+            Cached metric values that are still valid, keyed by metric name.
+        swapped : bool
+            True if the pair was given in the opposite of canonical order.
+        """
+        id1, id2, fingerprint, swapped = self._key(challenge_id1, file1,
+                                                   challenge_id2, file2)
+        sql = """
+              SELECT metric, value FROM metric_cache
+              WHERE challenge_id1 = ? AND challenge_id2 = ?
+                  AND fingerprint = ?
+              """
+        with self.repository.lock:
+            self.cursor.execute(sql, (id1, id2, fingerprint))
+            rows = self.cursor.fetchall()
+        values = dict((metric, value) for metric, value in rows
+                      if metrics is None or metric in metrics)
+        return values, swapped
+
+    def put(self, challenge_id1, file1, challenge_id2, file2, values):
+        """
+        Store metric values for a pair, replacing any stale entries.
+
+        Parameters
+        ----------
+        values : dict
+            Metric values keyed by metric name, already expressed for the
+            canonical pair order.
+        """
+        id1, id2, fingerprint, _ = self._key(challenge_id1, file1,
+                                             challenge_id2, file2)
+        sql = """
+              INSERT OR REPLACE INTO metric_cache VALUES
+              (?, ?, ?, ?, ?)
+              """
+        rows = [(id1, id2, metric, fingerprint, value)
+                for metric, value in values.items()]
+        with self.repository.lock:
+            self.cursor.executemany(sql, rows)
+            self.conn.commit()
+
+    def lookup_overlap(self, challenge_id1, file1, challenge_id2, file2):
+        """
+        Return the cached OverlapResult for a pair, or None on a miss.
+        """
+        values, swapped = self.get(challenge_id1, file1, challenge_id2, file2,
+                                   OverlapResult._fields)
+        if len(values) != len(OverlapResult._fields):
+            return None
+        result = OverlapResult(**values)
+        for field in ('size1', 'size2', 'intersection'):
+            result = result._replace(**{field: int(getattr(result, field))})
+        if swapped:
+            result = result.swapped()
+        return result
+
+    def store_overlap(self, challenge_id1, file1, challenge_id2, file2,
+                      result):
+        """
+        Cache an OverlapResult computed with the pair in the order given.
+        """
+        if challenge_id1 > challenge_id2:
+            result = result.swapped()
+        self.put(challenge_id1, file1, challenge_id2, file2,
+                 result._asdict())
+
+    def lookup_surface_distance(self, challenge_id1, file1, challenge_id2,
+                                file2):
+        """
+        Return the cached SurfaceDistanceResult for a pair, or None on a
+        miss.
+        """
+        fields = SurfaceDistanceResult._fields
+        values, _ = self.get(challenge_id1, file1, challenge_id2, file2,
+                             fields)
+        if len(values) != len(fields):
+            return None
+        return SurfaceDistanceResult(**values)
+
+    def store_surface_distance(self, challenge_id1, file1, challenge_id2,
+                               file2, result):
+        """
+        Cache a SurfaceDistanceResult.  The distances are symmetric, so the
+        pair order does not matter.
+        """
+        self.put(challenge_id1, file1, challenge_id2, file2,
+                 result._asdict())
+
+    def lookup_confusion(self, challenge_id1, file1, challenge_id2, file2):
+        """
+        Return the cached ConfusionMatrix for a pair, or None on a miss.
+        """
+        values, swapped = self.get(challenge_id1, file1, challenge_id2, file2)
+        cells = {}
+        for metric, value in values.items():
+            match = _CONFUSION.match(metric)
+            if match:
+                cells[int(match.group(1)), int(match.group(2))] = int(value)
+        if len(cells) == 0:
+            return None
+        labels = sorted(set(label for cell in cells for label in cell))
+        counts = [[cells.get((a, b), 0) for b in labels] for a in labels]
+        result = ConfusionMatrix(labels, counts)
+        if swapped:
+            result = result.swapped()
+        return result
+
+    def store_confusion(self, challenge_id1, file1, challenge_id2, file2,
+                        result):
+        """
+        Cache a ConfusionMatrix computed with the pair in the order given.
+        Only the nonzero counts are stored.
+        """
+        if challenge_id1 > challenge_id2:
+            result = result.swapped()
+        values = {}
+        for i, a in enumerate(result.labels):
+            for j, b in enumerate(result.labels):
+                if result.counts[i, j] != 0:
+                    metric = 'confusion[{0},{1}]'.format(a, b)
+                    values[metric] = int(result.counts[i, j])
+        self.put(challenge_id1, file1, challenge_id2, file2, values)
+
+    def lookup_sweep(self, challenge_id1, file1, challenge_id2, file2):
+        """
+        Return the cached threshold sweep for a pair, as (threshold,
+        OverlapResult) tuples in increasing threshold order, or None on a
+        miss.
+        """
+        values, swapped = self.get(challenge_id1, file1, challenge_id2, file2)
+        fields = {}
+        for metric, value in values.items():
+            match = _SWEEP.match(metric)
+            if match:
+                threshold = float(match.group(1))
+                fields.setdefault(threshold, {})[match.group(2)] = value
+        sweep = []
+        for threshold in sorted(fields):
+            if len(fields[threshold]) != len(OverlapResult._fields):
+                return None
+            result = OverlapResult(**fields[threshold])
+            for field in ('size1', 'size2', 'intersection'):
+                result = result._replace(**{field: int(getattr(result, field))})
+            if swapped:
+                result = result.swapped()
+            sweep.append((threshold, result))
+        return sweep or None
+
+    def store_sweep(self, challenge_id1, file1, challenge_id2, file2, sweep):
+        """
+        Cache a threshold sweep computed with the pair in the order given.
+        """
+        values = {}
+        for threshold, result in sweep:
+            if challenge_id1 > challenge_id2:
+                result = result.swapped()
+            for field, value in result._asdict().items():
+                values['sweep[{0!r}].{1}'.format(threshold, field)] = value
+        self.put(challenge_id1, file1, challenge_id2, file2, values)
@@ -0,0 +1,160 @@
+# -*- coding:  utf-8 -*-
+"""
+In-process overlap statistics between two segmentations.
+
+This replaces driving ``c3d -overlap`` in a subprocess, which re-read both
+NIfTI files from disk and required scraping its text output.
+"""
+import collections
+
+import numpy as np
+
+import roi
+
+
+_FIELDS = ['size1', 'size2', 'intersection', 'dice', 'jaccard',
+           'sensitivity', 'precision', 'volume_difference']
+
+
+class OverlapResult(collections.namedtuple('OverlapResult', _FIELDS)):
+    """
+    Overlap statistics for one label between two segmentations.
+
+    Ratios that are undefined because a mask is empty are None rather than
+    NaN.
+
+    Attributes
+    ----------
+    size1, size2 : int
+        Number of voxels in the first and second mask.
+    intersection : int
+        Number of voxels common to both masks.
+    dice, jaccard : float or None
+        Dice and Jaccard coefficients.  None if both masks are empty.
+    sensitivity : float or None
+        Fraction of the first mask covered by the second, i.e. the first
+        image is taken as the reference.  None if the first mask is empty.
+    precision : float or None
+        Fraction of the second mask covered by the first.  None if the
+        second mask is empty.
+    volume_difference : float
+        Volume of the second mask minus the volume of the first, in the
+        units of the voxel volume.
+    """
+    __slots__ = ()
+
+    def swapped(self):
+        """
+        Return the statistics as if the two images had been given in the
+        opposite order.
+
+        Dice and Jaccard are symmetric.  Sensitivity and precision trade
+        places, and the volume difference, being the second volume minus
+        the first, changes sign.  c3d -overlap, which this module replaces,
+        reports no volume difference, so there is no other convention to
+        follow.
+        """
+        # 0.0 - x rather than -x, so that no difference stays 0.0 instead
+        # of becoming -0.0 and being shown as "-0".
+        return OverlapResult(size1=self.size2,
+                             size2=self.size1,
+                             intersection=self.intersection,
+                             dice=self.dice,
+                             jaccard=self.jaccard,
+                             sensitivity=self.precision,
+                             precision=self.sensitivity,
+                             volume_difference=0.0 - self.volume_difference)
+
+    def summary(self):
+        """
+        Short human-readable description, suitable for a label widget.
+        """
+        if self.dice is None:
+            return 'Dice similarity coefficient:   undefined (both masks empty)'
+        lines = ['Dice similarity coefficient:   {0:.4f}'.format(self.dice),
+                 'Jaccard coefficient:   {0:.4f}'.format(self.jaccard),
+                 'Sensitivity:   {0}'.format(_fmt(self.sensitivity)),
+                 'Precision:   {0}'.format(_fmt(self.precision)),
+                 'Volume difference:   {0:g}'.format(self.volume_difference)]
+        return '\n'.join(lines)
+
+
+def _fmt(value):
+    if value is None:
+        return 'undefined'
+    return '{0:.4f}'.format(value)
+
+
+def _ratio(numerator, denominator):
+    if denominator == 0:
+        return None
+    return float(numerator) / denominator
+
+
+def overlap(image1, image2, label=1, voxel_volume=1.0, box=None):
+    """
+    Compute overlap statistics between two segmentations.
+
+    Parameters
+    ----------
+    image1, image2 : ndarray
+        Segmentation volumes of identical shape.
+    label : int
+        Label value to compare, as with ``c3d -overlap``.
+    voxel_volume : float
+        Volume of a single voxel, used to scale the volume difference.
+    box : tuple, optional
+        Region of interest containing every nonzero voxel of both images,
+        see the roi module.  Only voxels inside it are compared.
+
+    Returns
+    -------
+    OverlapResult
+    """
+    if image1.shape != image2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(image1.shape, image2.shape))
+
+    index = roi.to_slices(box)
+    mask1 = image1[index] == label
+    mask2 = image2[index] == label
+    return overlap_masks(mask1, mask2, voxel_volume=voxel_volume)
+
+
+def overlap_masks(mask1, mask2, voxel_volume=1.0):
+    """
+    Compute overlap statistics between two boolean masks.
+
+    See Also
+    --------
+    overlap
+    """
+    if mask1.shape != mask2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(mask1.shape, mask2.shape))
+
+    size1 = int(np.count_nonzero(mask1))
+    size2 = int(np.count_nonzero(mask2))
+    intersection = int(np.count_nonzero(np.logical_and(mask1, mask2)))
+    return overlap_counts(size1, size2, intersection,
+                          voxel_volume=voxel_volume)
+
+
+def overlap_counts(size1, size2, intersection, voxel_volume=1.0):
+    """
+    Compute overlap statistics from voxel counts.
+
+    See Also
+    --------
+    overlap
+    """
+    union = size1 + size2 - intersection
+
+    return OverlapResult(size1=size1,
+                         size2=size2,
+                         intersection=intersection,
+                         dice=_ratio(2 * intersection, size1 + size2),
+                         jaccard=_ratio(intersection, union),
+                         sensitivity=_ratio(intersection, size1),
+                         precision=_ratio(intersection, size2),
+                         volume_difference=(size2 - size1) * voxel_volume)
@@ -0,0 +1,123 @@
+"""
+Axial, coronal and sagittal planes of a volume.
+
+A plane is selected with basic indexing, so every plane is a strided view
+of the one volume held by the VolumeCache, memory-mapped or not.  Showing
+the three planes through a point, and moving that point, reads no files
+and copies no volume.
+
+A plane is identified by the array axis it cuts across.  The two remaining
+axes are its in-plane axes; the first runs horizontally on screen, as for
+the axial slices.
+"""
+import numpy as np
+
+
+SAGITTAL, CORONAL, AXIAL = 0, 1, 2
+PLANES = (AXIAL, CORONAL, SAGITTAL)
+NAMES = {AXIAL: 'axial', CORONAL: 'coronal', SAGITTAL: 'sagittal'}
+
+
+def in_plane_axes(axis):
+    """
+    The two array axes lying in the plane across the given axis.
+    """
+    return tuple(a for a in range(3) if a != axis)
+
+
+def plane_index(axis, slice_number):
+    """
+    Basic index expression selecting a slice across the given axis.
+    """
+    index = [slice(None)] * 3
+    index[axis] = slice_number
+    return tuple(index)
+
+
+def plane_slice(volume, axis, slice_number):
+    """
+    A slice across the given axis, as a view of the volume.
+    """
+    return volume[plane_index(axis, slice_number)]
+
+
+def pixel_scale(spacing, axis):
+    """
+    Horizontal and vertical display scale of the pixels of a plane, so that
+    the plane is shown with its true aspect ratio.  The finest spacing of
+    the volume is shown at scale 1.
+    """
+    spacing = [float(x) for x in spacing[:3]]
+    finest = min(spacing)
+    return tuple(spacing[a] / finest for a in in_plane_axes(axis))
+
+
+class Crosshair(object):
+    """
+    A voxel position shared by the three planes.  Each plane shows the
+    slice through the position, and marks where the other two cut it.
+
+    Attributes
+    ----------
+    shape : tuple
+        Shape of the volume.
+    position : list
+        Voxel index along each axis.
+    """
+    def __init__(self, shape, position=None):
+        self.shape = tuple(shape[:3])
+        if position is None:
+            position = [n // 2 for n in self.shape]
+        self.position = [int(np.clip(p, 0, n - 1))
+                         for p, n in zip(position, self.shape)]
+
+    def slice_number(self, axis):
+        """
+        The slice of the plane across the given axis.
+        """
+        return self.position[axis]
+
+    def move(self, axis, slice_number):
+        """
+        Move to another slice across the given axis.
+
+        Returns
+        -------
+        bool
+            True if the position changed.
+        """
+        slice_number = int(np.clip(slice_number, 0, self.shape[axis] - 1))
+        if slice_number == self.position[axis]:
+            return False
+        self.position[axis] = slice_number
+        return True
+
+    def click(self, axis, x, y):
+        """
+        A pixel of the plane across the given axis was clicked.  Move the
+        other two planes through it.
+
+        Parameters
+        ----------
+        axis : int
+            The plane clicked.
+        x, y : float
+            Pixel coordinates along the in-plane axes of that plane.
+
+        Returns
+        -------
+        list
+            The planes that now show a different slice.
+        """
+        moved = []
+        for other, value in zip(in_plane_axes(axis), (x, y)):
+            if self.move(other, int(np.floor(value))):
+                moved.append(other)
+        return moved
+
+    def point(self, axis):
+        """
+        Pixel coordinates of the position within the plane across the
+        given axis.
+        """
+        return tuple(self.position[a] for a in in_plane_axes(axis))
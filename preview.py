@@ -0,0 +1,136 @@
+"""
+Downsampled key-slice previews of base images and challenge runs.
+
+The key slice of a base image is the slice through the centroid of all of
+its runs.  Every run is previewed on that same slice, as the base image
+with the run's contour overlaid, so that the previews of a lesion can be
+compared side by side.  Previews are rendered at a few sizes and stored as
+PNG blobs in the database by make_db.py --previews.
+
+Runs whose shape differs from that of their base image cannot be overlaid
+on it.  They do not count towards the key slice, and their previews show
+the base image alone.
+"""
+import io
+import os
+
+import numpy as np
+
+from consensus import accumulate_votes
+from contours import slice_contour_points
+from geometry import read_geometry
+from rendering import RED, SliceRenderer
+from volume_cache import load_nifti
+
+# Longest side of each preview level, in pixels.
+SIZES = (64, 256)
+
+
+def key_slice(votes):
+    """
+    Slice through the centroid of the vote counts, or the middle slice if
+    there are no votes.
+    """
+    weights = votes.sum(axis=(0, 1), dtype=np.float64)
+    if weights.sum() == 0:
+        return votes.shape[2] // 2
+    k = np.dot(np.arange(len(weights)), weights) / weights.sum()
+    return int(round(k))
+
+
+def downsample(image_slice, size, reduce=np.mean):
+    """
+    Shrink a slice by an integer factor so that its longer side is at most
+    size pixels.  Each output pixel reduces one block of input pixels.
+    """
+    step = max(-(-max(image_slice.shape) // size), 1)
+    height = image_slice.shape[0] // step * step
+    width = image_slice.shape[1] // step * step
+    blocks = image_slice[:height, :width].reshape(height // step, step,
+                                                  width // step, step)
+    return reduce(reduce(blocks, axis=3), axis=1)
+
+
+def to_png(rgb):
+    """
+    Encode an RGB buffer as PNG.
+    """
+    from PIL import Image
+
+    f = io.BytesIO()
+    Image.fromarray(rgb).save(f, format='PNG', optimize=True)
+    return f.getvalue()
+
+
+def render_previews(task):
+    """
+    Render the previews of a base image and its runs.  This is run in a
+    worker process.
+
+    Parameters
+    ----------
+    task : tuple
+        (root, base image, runs, sizes) where the base image and each run
+        are given as (relative file path, mtime) tuples.
+
+    Returns
+    -------
+    rows : list
+        (relative file path, size, mtime, slice number, PNG bytes) tuples,
+        one per file and size.
+    skipped : list
+        (relative file path, reason) tuples for the runs drawn without
+        their contour.  Workers do not print; the parent reports these.
+    """
+    root, (base_relfile, base_mtime), runs, sizes = task
+    run_paths = [os.path.join(root, relfile) for relfile, _ in runs]
+    base_path = os.path.join(root, base_relfile)
+
+    base_data, _ = load_nifti(base_path)
+    shape = base_data.shape[:3]
+
+    # Only the headers are read to find the runs that line up with the
+    # base image.
+    matching = []
+    skipped = []
+    for (relfile, _), path in zip(runs, run_paths):
+        run_shape = read_geometry(path).shape[:3]
+        if run_shape == shape:
+            matching.append(path)
+        else:
+            msg = "shape {0} differs from base image shape {1}"
+            skipped.append((relfile, msg.format(run_shape, shape)))
+
+    if len(matching) > 0:
+        k = key_slice(accumulate_votes(matching))
+    else:
+        k = shape[2] // 2
+    base_slice = base_data[:, :, k]
+
+    renderer = SliceRenderer()
+    rows = []
+    for size in sizes:
+        image_slice = downsample(base_slice, size)
+        rgb = renderer.render(image_slice)
+        rows.append((base_relfile, size, base_mtime, k, to_png(rgb)))
+
+    # Previews are computed from the same slice of each run, with the mask
+    # downsampled by block maximum so that small lesions remain visible.
+    for (relfile, mtime), path in zip(runs, run_paths):
+        mask = None
+        if path in matching:
+            data, _ = load_nifti(path)
+            mask = (data[:, :, k] == 1).astype(np.uint8)
+        for size in sizes:
+            image_slice = downsample(base_slice, size)
+            overlays = []
+            if mask is not None:
+                small_mask = downsample(mask, size, reduce=np.max)
+                r, c = slice_contour_points(np.pad(small_mask, 1, 'constant'),
+                                            0.5)
+                overlays.append((np.clip(r - 1, 0, small_mask.shape[0] - 1),
+                                 np.clip(c - 1, 0, small_mask.shape[1] - 1),
+                                 RED))
+            rgb = renderer.render(image_slice, overlays)
+            rows.append((relfile, size, mtime, k, to_png(rgb)))
+    return rows, skipped
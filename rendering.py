@@ -0,0 +1,129 @@
+"""
+Render image slices with segmentation contours into an RGB buffer.
+"""
+import collections
+
+import numpy as np
+
+
+RED = (255, 0, 0)
+GREEN = (0, 255, 0)
+
+
+def window_level(image_slice, low=None, high=None, out=None, work=None):
+    """
+    Map intensities linearly onto 0-255, clipping outside the window.
+
+    With the default window this is the same as scipy.misc.bytescale.
+
+    Parameters
+    ----------
+    image_slice : ndarray
+        2D intensity image.
+    low, high : float, optional
+        Intensity window.  Defaults to the range of the slice.
+    out : ndarray, optional
+        uint8 array of the same shape to write into.
+    work : ndarray, optional
+        float32 array of the same shape to use as scratch space.
+
+    Returns
+    -------
+    ndarray
+        The uint8 image.
+    """
+    if low is None:
+        low = image_slice.min()
+    if high is None:
+        high = image_slice.max()
+    scale = 255.0 / (high - low) if high > low else 1.0
+
+    work = np.subtract(image_slice, low, out=work, dtype=np.float32)
+    work *= scale
+    work += 0.5
+    np.clip(work, 0, 255, out=work)
+    if out is None:
+        out = np.empty(image_slice.shape, dtype=np.uint8)
+    out[...] = work
+    return out
+
+
+class SliceRenderer(object):
+    """
+    Renders slices into a reused RGB buffer.
+
+    Slices are displayed transposed, i.e. the first array axis runs
+    horizontally, as they were when written out through scipy.misc.imsave.
+    Slices may be strided views of a volume; they are read once, into
+    scratch buffers that are reused from one render to the next.
+
+    Attributes
+    ----------
+    rgb : ndarray
+        C-contiguous uint8 array of shape (width, height, 3), suitable for
+        wrapping directly as an RGB888 QImage.
+    """
+    def __init__(self):
+        self.rgb = None
+        self._gray = None
+        self._work = None
+
+    def render(self, image_slice, overlays=(), low=None, high=None):
+        """
+        Render a slice and its contour overlays.
+
+        Parameters
+        ----------
+        image_slice : ndarray
+            2D intensity image of shape (height, width).
+        overlays : sequence
+            (rows, cols, color) tuples.  rows and cols are integer pixel
+            coordinates in the slice, color is an RGB triple.
+        low, high : float, optional
+            Intensity window, see window_level.
+
+        Returns
+        -------
+        ndarray
+            The RGB buffer.
+        """
+        shape = image_slice.T.shape
+        if self.rgb is None or self.rgb.shape[:2] != shape:
+            self.rgb = np.empty(shape + (3,), dtype=np.uint8)
+            self._gray = np.empty(shape, dtype=np.uint8)
+            self._work = np.empty(shape, dtype=np.float32)
+
+        window_level(image_slice.T, low=low, high=high, out=self._gray,
+                     work=self._work)
+        self.rgb[...] = self._gray[:, :, np.newaxis]
+
+        for rows, cols, color in overlays:
+            self.rgb[cols, rows] = color
+
+        return self.rgb
+
+
+class LatencyRecorder(object):
+    """
+    Keeps the most recent render times for percentile reporting.
+    """
+    def __init__(self, size=1000):
+        self.samples = collections.deque(maxlen=size)
+
+    def record(self, seconds):
+        self.samples.append(seconds)
+
+    def percentiles(self, q=(50, 90, 99)):
+        """
+        Latency percentiles in milliseconds, keyed by percentile.
+        """
+        if len(self.samples) == 0:
+            return {}
+        values = np.percentile(np.array(self.samples) * 1000.0, q)
+        return dict(zip(q, values))
+
+    def summary(self):
+        pct = self.percentiles()
+        items = ['p{0}={1:.1f}ms'.format(k, pct[k]) for k in sorted(pct)]
+        return 'render latency ({0} frames): {1}'.format(len(self.samples),
+                                                        ', '.join(items))
@@ -0,0 +1,282 @@
+"""
+Shared access to the moist challenge database.
+"""
+import itertools
+import os
+import sqlite3
+import threading
+
+from geometry import Geometry
+import roi
+import tracing
+
+# The database lives next to the scripts unless CTSEG_DB says otherwise, so
+# that it does not depend on the current working directory.
+DEFAULT_PATH = os.environ.get(
+    'CTSEG_DB',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 'moist_challenge.db'))
+
+# Columns that are filtered or joined on by the viewer and batch tools.
+INDEXES = [('challenge', 'label'),
+           ('challenge', 'base_image_id'),
+           ('challenge', 'file'),
+           ('base_image', 'label'),
+           ('base_image', 'file'),
+           ('base_image', 'collection_id')]
+
+_repositories = {}
+_repositories_lock = threading.Lock()
+
+
+def get_repository(path=None):
+    """
+    Return the process-wide repository for a database file, opening it on
+    first use.
+    """
+    path = os.path.abspath(path or DEFAULT_PATH)
+    with _repositories_lock:
+        if path not in _repositories:
+            _repositories[path] = Repository(path)
+        return _repositories[path]
+
+
+class Repository(object):
+    """
+    One long-lived connection to the database.
+
+    The database is put into WAL mode so that the indexer and batch tools
+    can write while the viewer reads.  The connection may be used from
+    helper threads; writers should hold the lock around each transaction.
+
+    Attributes
+    ----------
+    path : str
+        Location of the database file.
+    conn, cursor : database connection objects
+    lock : threading.RLock
+        Serializes use of the connection across threads.
+    """
+    def __init__(self, path=None):
+        self.path = os.path.abspath(path or DEFAULT_PATH)
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.cursor = self.conn.cursor()
+        self.lock = threading.RLock()
+
+        self.cursor.execute('PRAGMA journal_mode=WAL')
+        self.cursor.execute('PRAGMA synchronous=NORMAL')
+        self.create_indexes()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def has_table(self, table):
+        sql = """
+              SELECT COUNT(*) FROM sqlite_master
+              WHERE type = 'table' AND name = ?
+              """
+        self.cursor.execute(sql, (table,))
+        return self.cursor.fetchone()[0] > 0
+
+    def create_indexes(self):
+        """
+        Index the hot lookup columns of whichever tables exist so far.
+        """
+        with self.lock:
+            for table, column in INDEXES:
+                if not self.has_table(table):
+                    continue
+                sql = 'CREATE INDEX IF NOT EXISTS {0}_{1}_idx ON {0}({1})'
+                self.cursor.execute(sql.format(table, column))
+            self.conn.commit()
+
+    @tracing.traced('sql.collection_tree')
+    def collection_tree(self):
+        """
+        All collections with their base images, in a single query.
+
+        Returns
+        -------
+        list
+            (collection name, [(base image id, file, label), ...]) tuples.
+            Collections without base images have an empty list.
+        """
+        sql = """
+              SELECT collection.name,
+                     base_image.id, base_image.file, base_image.label
+              FROM collection
+              LEFT JOIN base_image
+                  ON base_image.collection_id = collection.id
+              ORDER BY collection.id, base_image.label
+              """
+        with self.lock:
+            self.cursor.execute(sql)
+            rows = self.cursor.fetchall()
+
+        tree = []
+        for name, group in itertools.groupby(rows, lambda row: row[0]):
+            base_images = [row[1:] for row in group if row[1] is not None]
+            tree.append((name, base_images))
+        return tree
+
+    @tracing.traced('sql.runs_for_label')
+    def runs_for_label(self, label):
+        """
+        (challenge id, team, run id, file) for every run of a base image.
+        """
+        sql = """
+              SELECT c.id, t.team, c.run_id, c.file
+              FROM challenge c INNER JOIN team t on t.id = c.team_id
+              WHERE label = ?
+              ORDER BY t.team, c.run_id
+              """
+        with self.lock:
+            self.cursor.execute(sql, (label,))
+            return self.cursor.fetchall()
+
+    @tracing.traced('sql.challenge_file')
+    def challenge_file(self, challenge_id):
+        """
+        Relative path of a challenge run.
+        """
+        sql = """
+              SELECT file FROM challenge
+              WHERE id = ?
+              """
+        with self.lock:
+            self.cursor.execute(sql, (challenge_id,))
+            return self.cursor.fetchone()[0]
+
+    @tracing.traced('sql.segmentation_rois')
+    def segmentation_rois(self, challenge_ids):
+        """
+        Bounding boxes of challenge runs, see the roi module.
+
+        Returns
+        -------
+        dict
+            Maps challenge IDs to boxes.  Runs whose box has not been
+            computed by make_db.py --roi are left out.
+        """
+        challenge_ids = list(challenge_ids)
+
+        # Boxes computed before the run file last changed are ignored.
+        sql = """
+              SELECT r.challenge_id, r.empty,
+                     r.istart, r.istop, r.jstart, r.jstop, r.kstart, r.kstop
+              FROM segmentation_roi r
+              INNER JOIN challenge c
+                  ON c.id = r.challenge_id AND c.mtime = r.mtime
+              WHERE r.challenge_id IN ({0})
+              """
+        rows = []
+        with self.lock:
+            if not self.has_table('segmentation_roi'):
+                return {}
+            # Stay below the limit on the number of SQL parameters.
+            for i in range(0, len(challenge_ids), 500):
+                chunk = challenge_ids[i:i + 500]
+                self.cursor.execute(sql.format(', '.join('?' * len(chunk))),
+                                    chunk)
+                rows.extend(self.cursor.fetchall())
+
+        boxes = {}
+        for row in rows:
+            if row[1]:
+                boxes[row[0]] = roi.EMPTY
+            else:
+                boxes[row[0]] = tuple(zip(row[2::2], row[3::2]))
+        return boxes
+
+    @tracing.traced('sql.geometry')
+    def geometry(self, relfiles):
+        """
+        Header geometry of base images and challenge runs, recorded by
+        make_db.py.
+
+        Returns
+        -------
+        dict
+            Maps relative file paths to Geometry tuples.  Files whose
+            geometry is missing or older than the file are left out.
+        """
+        relfiles = list(relfiles)
+        sql = """
+              SELECT g.file, g.shape, g.dtype, g.spacing, g.affine,
+                     g.file_size
+              FROM geometry g
+              INNER JOIN (SELECT file, mtime FROM base_image
+                          UNION ALL
+                          SELECT file, mtime FROM challenge) f
+                  ON f.file = g.file AND f.mtime = g.mtime
+              WHERE g.file IN ({0})
+              """
+        rows = []
+        with self.lock:
+            if not self.has_table('geometry'):
+                return {}
+            for i in range(0, len(relfiles), 500):
+                chunk = relfiles[i:i + 500]
+                self.cursor.execute(sql.format(', '.join('?' * len(chunk))),
+                                    chunk)
+                rows.extend(self.cursor.fetchall())
+        return dict((row[0], Geometry.from_row(row[1:])) for row in rows)
+
+    @tracing.traced('sql.previews')
+    def previews(self, relfiles, size):
+        """
+        PNG previews of base images and challenge runs, rendered by
+        make_db.py --previews.
+
+        Returns
+        -------
+        dict
+            Maps relative file paths to PNG bytes.  Files without a preview
+            of the given size are left out.
+        """
+        relfiles = list(relfiles)
+        sql = """
+              SELECT file, png FROM preview
+              WHERE size = ? AND file IN ({0})
+              """
+        rows = []
+        with self.lock:
+            if not self.has_table('preview'):
+                return {}
+            for i in range(0, len(relfiles), 500):
+                chunk = relfiles[i:i + 500]
+                self.cursor.execute(sql.format(', '.join('?' * len(chunk))),
+                                    [size] + chunk)
+                rows.extend(self.cursor.fetchall())
+        return dict((relfile, bytes(png)) for relfile, png in rows)
+
+    @tracing.traced('sql.base_image_id')
+    def base_image_id(self, label):
+        """
+        ID of the base image with the given label.
+        """
+        sql = """
+              SELECT id FROM base_image
+              WHERE label = ?
+              """
+        with self.lock:
+            self.cursor.execute(sql, (label,))
+            return self.cursor.fetchone()[0]
+
+    @tracing.traced('sql.base_image_file')
+    def base_image_file(self, label):
+        """
+        Relative path of the base image with the given label, or None if
+        there is no such base image.
+        """
+        sql = """
+              SELECT file FROM base_image
+              WHERE label = ?
+              """
+        with self.lock:
+            self.cursor.execute(sql, (label,))
+            row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return row[0]
@@ -0,0 +1,74 @@
+"""
+Bounding boxes of segmentations.
+
+The segmentations are small nodules inside whole-chest CT volumes, so most
+of the work on them can be restricted to a small region of interest.  A
+box is a tuple with one (start, stop) pair per axis, stop being exclusive.
+An empty mask has the empty box ``()``.  None stands for an unknown box,
+i.e. the whole volume.
+"""
+import numpy as np
+
+
+EMPTY = ()
+
+
+def bounding_box(mask):
+    """
+    Bounding box of the nonzero voxels of an array.
+    """
+    box = []
+    for axis in range(mask.ndim):
+        others = tuple(a for a in range(mask.ndim) if a != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=others))
+        if len(nonzero) == 0:
+            return EMPTY
+        box.append((int(nonzero[0]), int(nonzero[-1]) + 1))
+    return tuple(box)
+
+
+def union(*boxes):
+    """
+    Smallest box containing all of the given boxes.
+    """
+    if any(box is None for box in boxes):
+        return None
+    boxes = [box for box in boxes if box != EMPTY]
+    if len(boxes) == 0:
+        return EMPTY
+    return tuple((min(axis[0] for axis in axes), max(axis[1] for axis in axes))
+                 for axes in zip(*boxes))
+
+
+def pad(box, margin, shape):
+    """
+    Grow a box by a margin on every side, staying within the array shape.
+    """
+    if box is None or box == EMPTY:
+        return box
+    return tuple((max(start - margin, 0), min(stop + margin, n))
+                 for (start, stop), n in zip(box, shape))
+
+
+def to_slices(box):
+    """
+    Index expression selecting a box.  An unknown box selects everything,
+    an empty box selects nothing.
+    """
+    if box is None:
+        return Ellipsis
+    if box == EMPTY:
+        return (slice(0, 0),)
+    return tuple(slice(start, stop) for start, stop in box)
+
+
+def contains_slice(box, slice_number, axis=2):
+    """
+    True if the box may have nonzero voxels in the given slice.
+    """
+    if box is None:
+        return True
+    if box == EMPTY:
+        return False
+    start, stop = box[axis]
+    return start <= slice_number < stop
@@ -0,0 +1,156 @@
+"""
+Uncompressed, memory-mappable copies of the gzipped NIfTI segmentations.
+
+Reading a ``.nii.gz`` file means inflating the whole volume into memory.
+The sidecar store converts each volume once into a ``.npy`` file that can
+be memory-mapped, so that slicing a volume only touches the pages actually
+needed.
+"""
+import os
+
+import numpy as np
+
+import tracing
+
+
+class SidecarStore(object):
+    """
+    Attributes
+    ----------
+    root : str
+        Root directory where Nifty files are expected to be found.
+    directory : str
+        Directory holding the sidecar files, mirroring the layout under root.
+    repository : Repository, optional
+        If given, the sidecar path of each converted file is recorded in
+        the sidecar table.
+    """
+    def __init__(self, root, directory=None, repository=None):
+        self.root = root
+        if directory is None:
+            directory = os.path.join(root, '.sidecar')
+        self.directory = directory
+        self.repository = repository
+        if repository is not None:
+            self.conn = repository.conn
+            self.cursor = self.conn.cursor()
+            self.create_sidecar_table()
+
+    def create_sidecar_table(self):
+        sql = """
+              CREATE TABLE IF NOT EXISTS sidecar (
+                  file    TEXT PRIMARY KEY,
+                  sidecar TEXT
+              )
+              """
+        with self.repository.lock:
+            self.cursor.execute(sql)
+            self.conn.commit()
+
+    def sidecar_path(self, path):
+        """
+        Location of the sidecar file for a NIfTI file under the root.
+        """
+        relfile = os.path.relpath(os.path.abspath(path), self.root)
+        if relfile.endswith('.gz'):
+            relfile = relfile[:-3]
+        return os.path.join(self.directory, relfile + '.npy')
+
+    def stamp_path(self, path):
+        """
+        Location of the file recording which version of the source the
+        sidecar was converted from.
+        """
+        return self.sidecar_path(path) + '.stamp'
+
+    def fingerprint(self, path):
+        """
+        Size and mtime of the source, as stored in the stamp file.
+        """
+        st = os.stat(path)
+        return '{0}:{1!r}'.format(st.st_size, st.st_mtime)
+
+    def is_current(self, path):
+        """
+        True if the sidecar exists and was converted from the source as it
+        is now.  The source's size and mtime are compared for equality, so
+        that a source replaced by an older file is converted again.
+        """
+        if not os.path.isfile(self.sidecar_path(path)):
+            return False
+        try:
+            with open(self.stamp_path(path)) as f:
+                stamp = f.read().strip()
+            return stamp == self.fingerprint(path)
+        except (IOError, OSError):
+            return False
+
+    @tracing.traced('sidecar.convert')
+    def convert(self, path):
+        """
+        Write the sidecar for a NIfTI file, unless it is already current.
+
+        Returns
+        -------
+        str
+            Path of the sidecar file.
+        """
+        import nibabel as nib
+
+        sidecar = self.sidecar_path(path)
+        if not self.is_current(path):
+            dirname = os.path.dirname(sidecar)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+
+            # Write under a temporary name so that concurrent readers never
+            # see a partial file.  The source is fingerprinted before it is
+            # read, so a change during the conversion leaves it stale.
+            fingerprint = self.fingerprint(path)
+            tmpfile = '{0}.{1}.tmp'.format(sidecar, os.getpid())
+            with open(tmpfile, 'wb') as f:
+                np.save(f, nib.load(path).get_data())
+            os.rename(tmpfile, sidecar)
+
+            stamp = self.stamp_path(path)
+            tmpfile = '{0}.{1}.tmp'.format(stamp, os.getpid())
+            with open(tmpfile, 'w') as f:
+                f.write(fingerprint + '\n')
+            os.rename(tmpfile, stamp)
+            self.record(path, sidecar)
+
+        return sidecar
+
+    def record(self, path, sidecar):
+        """
+        Record the sidecar of a file in the database, if there is one.
+        """
+        if self.repository is not None:
+            relfile = os.path.relpath(os.path.abspath(path), self.root)
+            relsidecar = os.path.relpath(sidecar, self.root)
+            sql = """
+                  INSERT OR REPLACE INTO sidecar VALUES (?, ?)
+                  """
+            with self.repository.lock:
+                self.cursor.execute(sql, (relfile, relsidecar))
+                self.conn.commit()
+
+    @tracing.traced('sidecar.load')
+    def load(self, path):
+        """
+        Load the voxel data and voxel spacing of a NIfTI file.
+
+        Gzipped files are served from a memory-mapped sidecar, which is
+        created on first access.  Other files are loaded by nibabel, which
+        already memory-maps uncompressed NIfTI files.  This has the same
+        signature as volume_cache.load_nifti.
+        """
+        import nibabel as nib
+
+        img = nib.load(path)
+        zooms = img.header.get_zooms()
+        if not path.endswith('.gz'):
+            return img.get_data(), zooms
+
+        sidecar = self.convert(path)
+        return np.load(sidecar, mmap_mode='r'), zooms
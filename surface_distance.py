@@ -0,0 +1,145 @@
+# -*- coding:  utf-8 -*-
+"""
+Boundary distances between two segmentations.
+
+Comparing every surface point of one mask against every surface point of
+the other is quadratic.  Instead, one Euclidean distance transform of the
+surface of each mask is computed, cropped to the bounding box of both
+masks, and sampled at the surface points of the other mask.  The crop is
+exact because every surface point lies inside it.
+"""
+import collections
+
+import numpy as np
+
+import roi
+
+
+_FIELDS = ['hausdorff', 'hausdorff95', 'assd']
+
+
+class SurfaceDistanceResult(collections.namedtuple('SurfaceDistanceResult',
+                                                   _FIELDS)):
+    """
+    Symmetric surface distances between two segmentations, in the units of
+    the voxel spacing (mm for the challenge NIfTI files).
+
+    All distances are None if either mask is empty.
+
+    Attributes
+    ----------
+    hausdorff : float or None
+        Largest distance from a surface point of either mask to the surface
+        of the other.
+    hausdorff95 : float or None
+        The larger of the 95th percentiles of the distances from each
+        surface to the other.
+    assd : float or None
+        Average symmetric surface distance, the mean of the distances from
+        every surface point of both masks to the surface of the other.
+    """
+    __slots__ = ()
+
+    def swapped(self):
+        """
+        The distances are symmetric, so this is the result itself.
+        """
+        return self
+
+    def summary(self):
+        """
+        Short human-readable description, suitable for a label widget.
+        """
+        if self.hausdorff is None:
+            return 'Surface distances:   undefined (empty mask)'
+        lines = ['Hausdorff distance:   {0:.2f} mm'.format(self.hausdorff),
+                 'Hausdorff distance (95%):   {0:.2f} mm'.format(self.hausdorff95),
+                 'Average symmetric surface distance:   {0:.2f} mm'.format(self.assd)]
+        return '\n'.join(lines)
+
+
+def surface(mask):
+    """
+    Voxels of a mask with at least one face-connected neighbour outside it.
+    Voxels on the edge of the array count as surface.
+    """
+    import scipy.ndimage
+
+    return np.logical_and(mask, np.logical_not(
+        scipy.ndimage.binary_erosion(mask, border_value=0)))
+
+
+def directed_distances(surface1, surface2, spacing):
+    """
+    Distance from each point of the first surface to the second surface.
+    """
+    import scipy.ndimage
+
+    distance = scipy.ndimage.distance_transform_edt(np.logical_not(surface2),
+                                                    sampling=spacing)
+    return distance[surface1]
+
+
+def surface_distance(image1, image2, label=1, spacing=(1.0, 1.0, 1.0),
+                     box=None):
+    """
+    Compute surface distances between two segmentations.
+
+    Parameters
+    ----------
+    image1, image2 : ndarray
+        Segmentation volumes of identical shape.
+    label : int
+        Label value to compare.
+    spacing : sequence
+        Voxel spacing along each axis, e.g. the NIfTI zooms.
+    box : tuple, optional
+        Region of interest containing every nonzero voxel of both images,
+        see the roi module.
+
+    Returns
+    -------
+    SurfaceDistanceResult
+    """
+    if image1.shape != image2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(image1.shape, image2.shape))
+
+    index = roi.to_slices(box)
+    mask1 = image1[index] == label
+    mask2 = image2[index] == label
+    return surface_distance_masks(mask1, mask2, spacing=spacing)
+
+
+def surface_distance_masks(mask1, mask2, spacing=(1.0, 1.0, 1.0)):
+    """
+    Compute surface distances between two boolean masks.
+
+    See Also
+    --------
+    surface_distance
+    """
+    if mask1.shape != mask2.shape:
+        msg = "Image shapes {0} and {1} do not match."
+        raise ValueError(msg.format(mask1.shape, mask2.shape))
+
+    box1 = roi.bounding_box(mask1)
+    box2 = roi.bounding_box(mask2)
+    if box1 == roi.EMPTY or box2 == roi.EMPTY:
+        return SurfaceDistanceResult(None, None, None)
+
+    # Keep a margin so that the edge of the crop is not taken for surface.
+    index = roi.to_slices(roi.pad(roi.union(box1, box2), 1, mask1.shape))
+    spacing = [float(x) for x in spacing[:mask1.ndim]]
+    surface1 = surface(mask1[index])
+    surface2 = surface(mask2[index])
+
+    d12 = directed_distances(surface1, surface2, spacing)
+    d21 = directed_distances(surface2, surface1, spacing)
+
+    hausdorff = max(d12.max(), d21.max())
+    hausdorff95 = max(np.percentile(d12, 95), np.percentile(d21, 95))
+    assd = (d12.sum() + d21.sum()) / (len(d12) + len(d21))
+    return SurfaceDistanceResult(hausdorff=float(hausdorff),
+                                 hausdorff95=float(hausdorff95),
+                                 assd=float(assd))
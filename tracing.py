@@ -0,0 +1,215 @@
+"""
+Lightweight timing instrumentation with Chrome trace export.
+
+Code is instrumented with timed spans, which nest naturally,
+
+    with tracing.span('load', path=path) as args:
+        data = ...
+        args['bytes'] = data.nbytes
+
+and with instant events marking single moments.  Tracing is off by
+default, and then spans cost only a function call.  Setting CTSEG_TRACE
+to a file name turns it on for the whole process and writes the trace
+there on exit; tools can also call enable() themselves, e.g. for a
+--trace flag.
+
+The trace file is in the Chrome trace event format and can be opened with
+chrome://tracing or https://ui.perfetto.dev.
+
+Worker processes forked by multiprocessing, e.g. the scoring pools of
+agreement_matrix.py and batch_score.py, write their events to a file of
+their own when they exit, which the main process merges into the trace
+when it writes it.  Processes started any other way, e.g. with the spawn
+start method, are not traced.
+"""
+import atexit
+import functools
+import json
+import multiprocessing.util
+import os
+import threading
+import time
+import timeit
+
+_clock = timeit.default_timer
+
+
+class _NullSpan(object):
+    """
+    Stand-in for a span while tracing is disabled.
+    """
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = _clock()
+        return self.args
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = _clock()
+        if exc_type is not None:
+            self.args['error'] = repr(exc_value)
+        self.tracer.add({'name': self.name,
+                         'ph': 'X',
+                         'ts': self.tracer.timestamp(self.start),
+                         'dur': (end - self.start) * 1e6,
+                         'args': self.args})
+        return False
+
+
+class Tracer(object):
+    """
+    Collects trace events from all threads.
+
+    Attributes
+    ----------
+    enabled : bool
+        Whether spans and events are recorded.
+    path : str or None
+        File the trace is written to by save.
+    events : list
+        Recorded events, in Chrome trace event format.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.events = []
+        self._pid = os.getpid()
+        # Turns the clock into wall-clock time, so that the events of
+        # different processes line up.
+        self._offset = time.time() - _clock()
+        self._lock = threading.Lock()
+
+    def timestamp(self, t):
+        """
+        Microseconds since the epoch.
+        """
+        return (t + self._offset) * 1e6
+
+    def add(self, event):
+        pid = os.getpid()
+        event['pid'] = pid
+        event['tid'] = threading.current_thread().ident
+        with self._lock:
+            if pid != self._pid:
+                self._forked(pid)
+            self.events.append(event)
+
+    def _forked(self, pid):
+        """
+        First event in a forked worker process.  Drop the events inherited
+        from the parent and write this process's own when it exits.
+        """
+        self.events = []
+        self._pid = pid
+        if self.path is not None:
+            worker_path = '{0}.{1}.worker'.format(self.path, pid)
+            multiprocessing.util.Finalize(None, self.save,
+                                          args=(worker_path, False),
+                                          exitpriority=0)
+
+    def _merge_workers(self, path):
+        """
+        Move the events of the worker files of a trace into this tracer.
+        """
+        directory = os.path.dirname(path) or os.curdir
+        prefix = os.path.basename(path) + '.'
+        for name in os.listdir(directory):
+            if not (name.startswith(prefix) and name.endswith('.worker')):
+                continue
+            worker_path = os.path.join(directory, name)
+            with open(worker_path) as f:
+                events = json.load(f)['traceEvents']
+            os.remove(worker_path)
+            with self._lock:
+                self.events.extend(events)
+
+    def save(self, path=None, merge=True):
+        """
+        Write the trace, by default to the file given to enable.  Unless
+        merge is false, the events written by worker processes that have
+        exited are included.
+        """
+        path = path or self.path
+        if path is None:
+            return
+        if merge:
+            self._merge_workers(path)
+        with self._lock:
+            events = list(self.events)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+_tracer = Tracer()
+
+
+def enable(path=None):
+    """
+    Start recording, writing the trace to path when the process exits.
+    """
+    if not _tracer.enabled and path is not None:
+        atexit.register(_tracer.save)
+    _tracer.enabled = True
+    _tracer.path = path or _tracer.path
+
+
+def is_enabled():
+    return _tracer.enabled
+
+
+def span(name, **args):
+    """
+    Context manager timing the enclosed block.  It yields the dict of span
+    arguments, so that results such as byte counts can be added to it.
+    """
+    if not _tracer.enabled:
+        return _NULL_SPAN
+    return _Span(_tracer, name, args)
+
+
+def instant(name, **args):
+    """
+    Record a single moment, e.g. a choice made by the user.
+    """
+    if not _tracer.enabled:
+        return
+    _tracer.add({'name': name,
+                 'ph': 'i',
+                 's': 't',
+                 'ts': _tracer.timestamp(_clock()),
+                 'args': args})
+
+
+def traced(name):
+    """
+    Decorator wrapping every call of a function in a span.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save(path=None):
+    _tracer.save(path)
+
+
+if os.environ.get('CTSEG_TRACE'):
+    enable(os.environ['CTSEG_TRACE'])
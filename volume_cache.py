@@ -0,0 +1,133 @@
+"""
+Memory-budgeted LRU cache of loaded NIfTI volumes.
+"""
+import collections
+import os
+import threading
+
+import numpy as np
+
+import tracing
+
+
+def load_nifti(path):
+    """
+    Load the voxel data and voxel spacing of a NIfTI file.
+    """
+    import nibabel as nib
+
+    with tracing.span('nifti.header', path=path):
+        img = nib.load(path)
+    # Reading a gzipped file is dominated by decompression.
+    name = 'nifti.decompress' if path.endswith('.gz') else 'nifti.read'
+    with tracing.span(name, path=path) as args:
+        data = img.get_data()
+        args['file_bytes'] = os.path.getsize(path)
+        # A memory map is read lazily, so only report the size of data that
+        # was actually read.
+        if not isinstance(data, np.memmap):
+            args['data_bytes'] = data.nbytes
+    return data, img.header.get_zooms()
+
+
+def _resident_size(data):
+    """
+    Memory charged against the budget for an array.  Memory-mapped arrays
+    are backed by the page cache rather than process memory, so they are
+    not charged.
+    """
+    if isinstance(data, np.memmap):
+        return 0
+    return data.nbytes
+
+
+def _signature(path):
+    """
+    Identify the current state of a file by its mtime and size.
+    """
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+class VolumeCache(object):
+    """
+    Least-recently-used cache of volumes, bounded by total array size.
+
+    Each volume is kept with the mtime and size of its file, and is loaded
+    again if the file has changed since, e.g. when a consensus is rebuilt.
+
+    Attributes
+    ----------
+    max_bytes : int
+        Budget for the total size of the cached arrays.
+    loader : callable
+        Maps a path to a (data, zooms) tuple, e.g. load_nifti or
+        SidecarStore.load.
+    hits, misses : int
+        Number of lookups served from memory and from disk.
+    """
+    def __init__(self, max_bytes=1024 ** 3, loader=load_nifti):
+        self.max_bytes = max_bytes
+        self.loader = loader
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.RLock()
+
+    def __contains__(self, path):
+        return os.path.realpath(path) in self._entries
+
+    def _entry(self, path):
+        key = os.path.realpath(path)
+        signature = _signature(key)
+        with self._lock:
+            if key in self._entries:
+                entry = self._entries.pop(key)
+                if entry[2] == signature:
+                    self.hits += 1
+                    self._entries[key] = entry
+                    return entry
+                self.nbytes -= _resident_size(entry[0])
+            self.misses += 1
+
+        with tracing.span('volume_cache.load', path=path) as args:
+            data, zooms = self.loader(path)
+            entry = (data, zooms, signature)
+            size = _resident_size(data)
+            args['resident_bytes'] = size
+
+        with self._lock:
+            if size > self.max_bytes or key in self._entries:
+                return entry
+            self._entries[key] = entry
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (data, _, _) = self._entries.popitem(last=False)
+                self.nbytes -= _resident_size(data)
+        return entry
+
+    def get(self, path):
+        """
+        Return the voxel data for a NIfTI file, loading it if necessary.
+        """
+        return self._entry(path)[0]
+
+    def get_zooms(self, path):
+        """
+        Return the voxel spacing for a NIfTI file, loading it if necessary.
+        """
+        return self._entry(path)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        Summary of cache usage, e.g. for logging.
+        """
+        msg = "volume cache: {0} hits, {1} misses, {2} volumes, {3:.1f} MB"
+        return msg.format(self.hits, self.misses, len(self._entries),
+                          self.nbytes / 1024.0 ** 2)